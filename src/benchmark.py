@@ -0,0 +1,462 @@
+
+'''
+Benchmark suite for the LVIS pipeline,
+run on synthetic data so it works on
+any Linux box. Each stage is timed and
+memory-profiled at several scales, and
+compared against stored baselines.
+Stages with a fast path also check it
+gives the same answer as the simple one
+'''
+
+###################################
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import tempfile
+import tracemalloc
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from synthLVIS import writeSynthLVIS,writeSynthDEM,writeSynthBoundary
+
+
+###################################
+
+# pipeline stages, in order
+STAGES=['readLVIS','readLVISLazy','setElevations','estimateGround','estimateGroundCompact','writeTiff','task3','clip_and_fill','DEMAnalysis']
+
+# stages that work on waveforms, reported as shots per second
+SHOT_STAGES=('readLVIS','readLVISLazy','setElevations','estimateGround','estimateGroundCompact','writeTiff','task3')
+
+# stages that need the synthetic DEMs and boundary
+RASTER_STAGES=('clip_and_fill','DEMAnalysis')
+
+
+###################################
+
+class stageTimer(object):
+  '''
+  Context manager timing the part of a
+  stage being benchmarked: wall and CPU
+  time and the peak Python heap, which
+  includes numpy arrays
+  '''
+
+  def __enter__(self):
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    self.wall=time.perf_counter()
+    self.cpu=time.process_time()
+    return(self)
+
+  def __exit__(self,*args):
+    self.wall=time.perf_counter()-self.wall
+    self.cpu=time.process_time()-self.cpu
+    self.peakMB=tracemalloc.get_traced_memory()[1]/1e6
+    tracemalloc.stop()
+    return(False)
+
+
+###################################
+
+def demSize(nShots):
+  '''
+  DEM side in pixels to go with
+  a scale of nShots
+  '''
+  return(max(256,int(8*np.sqrt(nShots))))
+
+
+###################################
+
+def makeFixtures(workDir,nShots,nBins=500,nFiles=2,stages=STAGES):
+  '''
+  Write the synthetic inputs for one scale,
+  reusing those from an earlier run. The
+  DEMs and boundary are only written if a
+  raster stage is among stages
+  '''
+  folder=os.path.join(workDir,"shots_"+str(nShots)+"_bins_"+str(nBins))
+  lvisFolder=os.path.join(folder,"lvis")
+  os.makedirs(lvisFolder,exist_ok=True)
+  size=demSize(nShots)
+  fixture={'nShots':nShots,'nBins':nBins,'folder':folder,'lvisFolder':lvisFolder,'demSize':size,
+           'lvis':[os.path.join(lvisFolder,"ILVIS1B_SYNTH_"+str(seed)+".h5") for seed in range(nFiles)],
+           'dem2009':os.path.join(folder,"dem_2009.tif"),'dem2015':os.path.join(folder,"dem_2015.tif"),
+           'boundary':os.path.join(folder,"boundary.shp")}
+
+  for seed,name in enumerate(fixture['lvis']):
+    if(not os.path.exists(name)):
+      print("Writing",name)
+      writeSynthLVIS(name,nShots=nShots,nBins=nBins,seed=seed)
+  if(not any(stage in RASTER_STAGES for stage in stages)):
+    return(fixture)
+  for name,year,change in ((fixture['dem2009'],2009,0.0),(fixture['dem2015'],2015,-5.0)):
+    if(not os.path.exists(name)):
+      print("Writing",name)
+      writeSynthDEM(name,nX=size,nY=size,seed=year,change=change)
+  if(not os.path.exists(fixture['boundary'])):
+    writeSynthBoundary(fixture['boundary'],nX=size,nY=size)
+  return(fixture)
+
+
+###################################
+# the stages. Each does its set up, then
+# times only the stage itself with timer
+
+def benchReadLVIS(fixture,timer,outDir):
+  from lvisClass import lvisData
+  with timer:
+    lvisData(fixture['lvis'][0])
+
+
+def benchReadLVISLazy(fixture,timer,outDir):
+  from lvisClass import lvisData
+  with timer:
+    with lvisData(fixture['lvis'][0],lazy=True) as lvis:    # coordinates only
+      lvis.dumpBounds()
+
+
+def benchSetElevations(fixture,timer,outDir):
+  from lvisClass import lvisData
+  lvis=lvisData(fixture['lvis'][0])
+  with timer:
+    lvis.setElevations()
+
+
+def benchEstimateGround(fixture,timer,outDir):
+  from processLVIS import lvisGround
+  lvis=lvisGround(fixture['lvis'][0],setElev=True)
+  with timer:
+    lvis.estimateGround()
+
+
+def benchEstimateGroundCompact(fixture,timer,outDir):
+  from processLVIS import lvisGround
+  lvis=lvisGround(fixture['lvis'][0],setElev=True,precision='compact')
+  with timer:
+    lvis.estimateGround()
+
+
+def benchWriteTiff(fixture,timer,outDir):
+  from tiffExample import writeTiff
+  from processLVIS import lvisGround
+  from handleProj import reprojectCoords
+  lvis=lvisGround(fixture['lvis'][0],setElev=True)
+  lvis.estimateGround()
+  x,y=reprojectCoords(lvis.lon,lvis.lat,4326,3031)
+  with timer:
+    writeTiff(lvis.zG,x,y,30,filename=os.path.join(outDir,"dem.tif"),epsg=3031)
+
+
+def benchTask3(fixture,timer,outDir):
+  from task3 import process_files_to_dem
+  from tileCache import tileCache
+  with timer:
+    process_files_to_dem(fixture['lvisFolder'],outDir,4,100,cache=tileCache(outDir,enabled=False),rebuild=True)
+
+
+def benchClipAndFill(fixture,timer,outDir):
+  from task4 import clip_and_fill
+  with timer:
+    clip_and_fill(fixture['dem2009'],fixture['boundary'],os.path.join(outDir,"filled.tif"),-999.0,20,0,workers=os.cpu_count())
+
+
+def benchDEMAnalysis(fixture,timer,outDir):
+  from task5 import DEMAnalysis
+  with timer:
+    DEMAnalysis(fixture['dem2009'],fixture['dem2015'],boundary_shapefile=fixture['boundary']).create_change_map(
+      os.path.join(outDir,"change.tif"),show_map=False)
+
+
+STAGE_FUNCS={'readLVIS':benchReadLVIS,'readLVISLazy':benchReadLVISLazy,'setElevations':benchSetElevations,'estimateGround':benchEstimateGround,
+             'estimateGroundCompact':benchEstimateGroundCompact,
+             'writeTiff':benchWriteTiff,'task3':benchTask3,'clip_and_fill':benchClipAndFill,'DEMAnalysis':benchDEMAnalysis}
+
+
+###################################
+# checks that a stage's fast path gives the
+# same answer as the simple one it replaced.
+# Run once per stage, untimed
+
+# shots run through the per-waveform ground engine in its check
+CHECK_SHOTS=500
+
+
+def checkEqual(name,a,b):
+  '''
+  Raise an AssertionError if two arrays
+  differ in shape or in any value
+  '''
+  a=np.asarray(a)
+  b=np.asarray(b)
+  if(a.shape!=b.shape):
+    raise AssertionError(name+": shape "+str(a.shape)+" vs "+str(b.shape))
+  differ=~((a==b)|(np.isnan(a)&np.isnan(b))) if(a.dtype.kind=='f') else (a!=b)
+  if(np.any(differ)):
+    raise AssertionError(name+": "+str(int(np.count_nonzero(differ)))+" of "+str(a.size)+" values differ")
+
+
+def checkReadLVIS(fixture,outDir):
+  '''
+  Reads through the spatial index give
+  the same shots as a scan of every shot,
+  for boxes inside, across the edge of
+  and outside the file
+  '''
+  from lvisClass import lvisData
+  from lvisIndex import getIndex
+  bounds=getIndex(fixture['lvis'][0]).bounds
+  width=bounds[2]-bounds[0]
+  height=bounds[3]-bounds[1]
+  boxes=[(bounds[0]+0.3*width,bounds[1]+0.2*height,bounds[0]+0.6*width,bounds[1]+0.7*height),
+         (bounds[0]-0.1*width,bounds[1]-0.1*height,bounds[0]+0.25*width,bounds[1]+0.5*height),
+         (bounds[0],bounds[1],bounds[2],bounds[3]),
+         (bounds[2]+1.0,bounds[3]+1.0,bounds[2]+2.0,bounds[3]+2.0)]
+  for minX,minY,maxX,maxY in boxes:
+    indexed=lvisData(fixture['lvis'][0],minX=minX,minY=minY,maxX=maxX,maxY=maxY,useIndex=True)
+    scanned=lvisData(fixture['lvis'][0],minX=minX,minY=minY,maxX=maxX,maxY=maxY,useIndex=False)
+    if(indexed.nWaves!=scanned.nWaves):
+      raise AssertionError("index query vs full scan: "+str(indexed.nWaves)+" vs "+str(scanned.nWaves)+" shots")
+    if(indexed.nWaves>0):
+      checkEqual("index query vs full scan",indexed.lShot,scanned.lShot)
+
+
+def checkEstimateGround(fixture,outDir):
+  '''
+  The vectorized ground engine gives the
+  same zG as the per-waveform loop, over
+  several blocks
+  '''
+  from processLVIS import lvisGround
+  inds=np.arange(min(CHECK_SHOTS,fixture['nShots']))
+  loop=lvisGround.readShots(fixture['lvis'][0],inds=inds)
+  vectorized=lvisGround.readShots(fixture['lvis'][0],inds=inds)
+  loop.estimateGround(engine="loop")
+  vectorized.estimateGround(engine="vectorized",blockSize=128)
+  checkEqual("vectorized vs loop ground",vectorized.zG,loop.zG)
+
+
+def checkTask3(fixture,outDir):
+  '''
+  Footprint stores built by a process
+  pool match those built serially
+  '''
+  from task3 import build_footprints
+  from footprintStore import footprintStore,COLUMNS
+  serial=build_footprints(fixture['lvis'],os.path.join(outDir,"serial"),4,workers=1)
+  parallel=build_footprints(fixture['lvis'],os.path.join(outDir,"parallel"),4,workers=2)
+  for serialPath,parallelPath in zip(serial,parallel):
+    a=footprintStore(serialPath)
+    b=footprintStore(parallelPath)
+    for name in COLUMNS:
+      checkEqual("serial vs parallel footprints, "+name,getattr(b,name),getattr(a,name))
+
+
+def checkClipAndFill(fixture,outDir,blockSize=16,maxSearch=4,smoothing=1):
+  '''
+  Block by block filling matches one
+  fillnodata call over the whole DEM. A
+  hole wider than a block and its halo is
+  cut first, so some blocks read nothing
+  but nodata
+  '''
+  import rasterio
+  from rasterio.fill import fillnodata
+  from task4 import clip_and_fill
+  from boundaryMask import getBoundaryMask
+  nodata=-999.0
+  with rasterio.open(fixture['dem2009']) as src:
+    profile=src.profile
+    data=src.read(1)
+  hole=3*blockSize+2*(maxSearch+smoothing)
+  r0=data.shape[0]//3
+  c0=data.shape[1]//3
+  data[r0:r0+hole,c0:c0+hole]=nodata
+  holed=os.path.join(outDir,"holed.tif")
+  with rasterio.open(holed,'w',**profile) as dst:
+    dst.write(data,1)
+
+  filled=os.path.join(outDir,"filled.tif")
+  clip_and_fill(holed,fixture['boundary'],filled,nodata,maxSearch,smoothing,block_size=blockSize,workers=2)
+  with rasterio.open(filled) as src:
+    blockwise=src.read(1)
+
+  whole=fillnodata(data,mask=(data!=nodata).astype(np.uint8),max_search_distance=maxSearch,smoothing_iterations=smoothing)
+  boundary=getBoundaryMask(fixture['boundary'],profile['transform'],data.shape,profile['crs'])
+  crop=boundary.cropWindow()
+  whole=whole[crop.row_off:crop.row_off+crop.height,crop.col_off:crop.col_off+crop.width]
+  checkEqual("block fill vs whole raster fill",blockwise,boundary.apply(whole,nodata))
+
+
+CHECK_FUNCS={'readLVIS':checkReadLVIS,'estimateGround':checkEstimateGround,'task3':checkTask3,'clip_and_fill':checkClipAndFill}
+
+
+###################################
+
+def runStage(stage,fixture,repeats):
+  '''
+  Run one stage repeats times in this
+  (fresh) process, then its check if it
+  has one. Returns the best wall and CPU
+  time, the largest heap peak and the
+  process's peak RSS
+  '''
+  import io
+  from contextlib import redirect_stdout
+  result={'stage':stage,'nShots':fixture['nShots'],'nBins':fixture['nBins']}
+  walls=[]
+  cpus=[]
+  peaks=[]
+  try:
+    for i in range(repeats):
+      timer=stageTimer()
+      with tempfile.TemporaryDirectory() as outDir, redirect_stdout(io.StringIO()):
+        STAGE_FUNCS[stage](fixture,timer,outDir)
+      walls.append(timer.wall)
+      cpus.append(timer.cpu)
+      peaks.append(timer.peakMB)
+    if(stage in CHECK_FUNCS):
+      with tempfile.TemporaryDirectory() as outDir, redirect_stdout(io.StringIO()):
+        CHECK_FUNCS[stage](fixture,outDir)
+  except ImportError as err:   # e.g. GDAL not installed here
+    result['status']="skipped: "+str(err)
+    return(result)
+  except AssertionError as err:
+    result['status']="failed: "+str(err)
+    return(result)
+  result.update({'status':'ok','wall':min(walls),'cpu':min(cpus),'peakMB':max(peaks),
+                 'maxRssMB':resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1e3})
+  if(stage in SHOT_STAGES):
+    nShots=fixture['nShots']*(len(fixture['lvis']) if(stage=='task3') else 1)
+    result['shotsPerSec']=nShots/result['wall']
+  return(result)
+
+
+###################################
+
+def runSuite(stages,scales,workDir,repeats=3,nBins=500):
+  '''
+  Run every stage at every scale, each
+  in its own process so memory peaks
+  are not mixed up between stages
+  '''
+  context=multiprocessing.get_context('spawn')
+  results=[]
+  for nShots in scales:
+    fixture=makeFixtures(workDir,nShots,nBins=nBins,stages=stages)
+    for stage in stages:
+      with ProcessPoolExecutor(max_workers=1,mp_context=context) as pool:
+        result=pool.submit(runStage,stage,fixture,repeats).result()
+      results.append(result)
+      printResult(result)
+  return(results)
+
+
+###################################
+
+def resultKey(result):
+  '''
+  Baseline entry for a result, by stage,
+  shot count and bins per waveform
+  '''
+  return(result['stage']+"@"+str(result['nShots'])+"x"+str(result['nBins']))
+
+
+###################################
+
+def compare(results,baseline,tolerance=0.25,memTolerance=0.25):
+  '''
+  Flag results that failed their check,
+  or are slower, or with a higher heap
+  peak, than the baseline by more than
+  the tolerance (a fraction)
+  '''
+  regressions=[]
+  for result in results:
+    if(result['status'].startswith("failed")):
+      regressions.append(resultKey(result)+": "+result['status'])
+      continue
+    base=baseline.get(resultKey(result))
+    if((base is None)or(result['status']!='ok')):
+      continue
+    if(result['wall']>base['wall']*(1.0+tolerance)):
+      regressions.append(resultKey(result)+": wall "+"%.3f s vs %.3f s baseline"%(result['wall'],base['wall']))
+    if(result['peakMB']>base['peakMB']*(1.0+memTolerance)+1.0):   # ignore changes under a MB
+      regressions.append(resultKey(result)+": peak heap "+"%.1f MB vs %.1f MB baseline"%(result['peakMB'],base['peakMB']))
+  return(regressions)
+
+
+###################################
+
+def printResult(result):
+  '''
+  One line summary of a result
+  '''
+  if(result['status']!='ok'):
+    print("%-22s %8d shots  %s"%(result['stage'],result['nShots'],result['status']))
+    return
+  rate=" %10.0f shots/s"%result['shotsPerSec'] if('shotsPerSec' in result) else ""
+  print("%-22s %8d shots %9.3f s wall %9.3f s cpu %9.1f MB heap %9.1f MB rss%s"%(
+        result['stage'],result['nShots'],result['wall'],result['cpu'],result['peakMB'],result['maxRssMB'],rate))
+
+
+###################################
+
+def getCmdArgs():
+  '''
+  Get commandline arguments
+  '''
+  p=argparse.ArgumentParser(description=("Benchmark the LVIS pipeline on synthetic data"))
+  p.add_argument("--stages",dest="stages",type=str,default=",".join(STAGES),help=("Comma separated stages to run"))
+  p.add_argument("--scales",dest="scales",type=str,default="2000,20000,100000",help=("Comma separated shots per LVIS file"))
+  p.add_argument("--nBins",dest="nBins",type=int,default=500,help=("Bins per waveform"))
+  p.add_argument("--repeats",dest="repeats",type=int,default=3,help=("Runs per stage, the fastest is kept"))
+  p.add_argument("--workDir",dest="workDir",type=str,default=os.path.join(tempfile.gettempdir(),"lvis_benchmark"),help=("Folder for the synthetic inputs, reused between runs"))
+  p.add_argument("--baseline",dest="baseline",type=str,default="benchmark_baseline.json",help=("Baseline results to compare against"))
+  p.add_argument("--saveBaseline",dest="saveBaseline",action='store_true',help=("Store these results as the new baseline"))
+  p.add_argument("--tolerance",dest="tolerance",type=float,default=0.25,help=("Fractional slow down or memory growth flagged as a regression"))
+  p.add_argument("--output",dest="output",type=str,default=None,help=("Write the results to this JSON file"))
+  return(p.parse_args())
+
+
+###################################
+
+if __name__=="__main__":
+  '''Main block'''
+  cmd=getCmdArgs()
+  stages=[s for s in cmd.stages.split(",") if s]
+  for stage in stages:
+    if(stage not in STAGE_FUNCS):
+      raise ValueError("Unknown stage "+stage+", choose from "+",".join(STAGES))
+  scales=[int(s) for s in cmd.scales.split(",") if s]
+
+  results=runSuite(stages,scales,cmd.workDir,repeats=cmd.repeats,nBins=cmd.nBins)
+  if(cmd.output is not None):
+    with open(cmd.output,'w') as f:
+      json.dump(results,f,indent=1)
+
+  # compare with, or replace, the baseline
+  baseline={}
+  if(os.path.exists(cmd.baseline)):
+    with open(cmd.baseline) as f:
+      baseline=json.load(f)
+  if(cmd.saveBaseline):
+    for result in results:
+      if(result['status']=='ok'):
+        baseline[resultKey(result)]={'wall':result['wall'],'cpu':result['cpu'],'peakMB':result['peakMB']}
+    with open(cmd.baseline,'w') as f:
+      json.dump(baseline,f,indent=1,sort_keys=True)
+    print("Baseline written to",cmd.baseline)
+  else:
+    regressions=compare(results,baseline,tolerance=cmd.tolerance,memTolerance=cmd.tolerance)
+    for line in regressions:
+      print("REGRESSION",line)
+    if(len(regressions)>0):
+      sys.exit(1)
+    print("No regressions against",cmd.baseline if(len(baseline)>0) else "an empty baseline")
+
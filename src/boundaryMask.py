@@ -0,0 +1,241 @@
+
+'''
+A boundary shapefile rasterised once
+per grid and cached on disk as a packed
+bitmask, so clipping is a cheap array
+operation on every later run
+'''
+
+###################################
+import os
+import numpy as np
+from rasterio.features import geometry_mask
+from rasterio.windows import Window
+from rasterio.transform import Affine
+from tileCache import makeKey, inputFingerprint
+
+
+###################################
+
+# masks already loaded by this process, by key
+_maskCache={}
+
+
+###################################
+
+def getBoundaryMask(shapefile,transform,shape,crs,cacheDir=None):
+  '''
+  Return the mask of shapefile on the grid
+  given by an affine transform, a (height,
+  width) shape and a CRS, reusing one this
+  process or an earlier run already made
+  '''
+  key=maskKey(shapefile,transform,shape,crs)
+  mask=_maskCache.get(key)
+  if(mask is None):
+    mask=boundaryMask(shapefile,transform,shape,crs,cacheDir=cacheDir,key=key)
+    _maskCache[key]=mask
+  return(mask)
+
+
+###################################
+
+def maskKey(shapefile,transform,shape,crs):
+  '''
+  Identify a mask by the grid and the
+  shapefile it was made from, including
+  the .prj holding the shapefile's CRS
+  '''
+  prj=os.path.splitext(shapefile)[0]+".prj"
+  return(makeKey(shapefile=inputFingerprint(shapefile),prj=inputFingerprint(prj) if(os.path.exists(prj)) else None,
+                 transform=[float(v) for v in tuple(transform)[:6]],shape=[int(v) for v in shape],crs=str(crs)))
+
+
+###################################
+
+def readBoundary(shapefile,crs):
+  '''
+  Boundary geometries reprojected
+  to crs
+  '''
+  import geopandas as gpd    # only needed when a mask is made
+  boundary=gpd.read_file(shapefile)
+  boundary=boundary.to_crs(crs)
+  return([feature.geometry for feature in boundary.itertuples()])
+
+
+###################################
+
+class boundaryMask(object):
+  '''
+  Pixels of a grid inside a boundary.
+  window=(colOff,rowOff,width,height) is
+  the part of the grid the boundary
+  covers, and inside holds the mask for
+  that window only
+  '''
+
+  def __init__(self,shapefile,transform,shape,crs,cacheDir=None,key=None):
+    '''
+    Class initialiser. Loads the cached
+    mask if there is one, otherwise
+    rasterises the shapefile and saves it
+    '''
+    self.key=key if(key is not None) else maskKey(shapefile,transform,shape,crs)
+    self.shape=(int(shape[0]),int(shape[1]))
+    cacheDir=cacheDir if(cacheDir is not None) else os.path.dirname(os.path.abspath(shapefile))
+    base=os.path.splitext(os.path.basename(shapefile))[0]
+    self.cacheName=os.path.join(cacheDir,base+"."+self.key[:16]+".mask.npz")
+    if(not self.loadMask()):
+      self.buildMask(shapefile,transform,crs)
+      self.saveMask()
+
+
+  ###########################################
+
+  def buildMask(self,shapefile,transform,crs):
+    '''
+    Rasterise the boundary over the
+    window of the grid it covers
+    '''
+    shapes=readBoundary(shapefile,crs)
+
+    # window covering the boundary, in whole pixels, cut to the grid
+    minX=min(s.bounds[0] for s in shapes)
+    minY=min(s.bounds[1] for s in shapes)
+    maxX=max(s.bounds[2] for s in shapes)
+    maxY=max(s.bounds[3] for s in shapes)
+    cols,rows=~transform*(np.array([minX,maxX,maxX,minX]),np.array([minY,minY,maxY,maxY]))
+    col0=int(np.clip(np.floor(np.min(cols)),0,self.shape[1]))
+    col1=int(np.clip(np.ceil(np.max(cols)),0,self.shape[1]))
+    row0=int(np.clip(np.floor(np.min(rows)),0,self.shape[0]))
+    row1=int(np.clip(np.ceil(np.max(rows)),0,self.shape[0]))
+    self.window=(col0,row0,col1-col0,row1-row0)
+
+    if((col1>col0)and(row1>row0)):
+      windowTransform=transform*Affine.translation(col0,row0)
+      self.inside=geometry_mask(shapes,out_shape=(row1-row0,col1-col0),transform=windowTransform,invert=True)
+    else:
+      self.inside=np.zeros((row1-row0,col1-col0),dtype=bool)
+
+
+  ###########################################
+
+  def loadMask(self):
+    '''
+    Load the cached mask. Returns False
+    if there is none or it is stale
+    '''
+    if(not os.path.exists(self.cacheName)):
+      return(False)
+    try:
+      with np.load(self.cacheName) as d:
+        if(str(d['key'])!=self.key):
+          return(False)
+        self.window=tuple(int(v) for v in d['window'])
+        nPix=self.window[2]*self.window[3]
+        self.inside=np.unpackbits(d['packed'],count=nPix).astype(bool).reshape(self.window[3],self.window[2])
+    except (OSError,KeyError,ValueError):   # unreadable or old layout
+      return(False)
+    return(True)
+
+
+  ###########################################
+
+  def saveMask(self):
+    '''
+    Save the mask packed 8 pixels a byte.
+    Read-only folders are skipped and the
+    mask is kept in memory instead
+    '''
+    tempName=self.cacheName+".tmp.npz"
+    try:
+      np.savez(tempName,key=self.key,window=np.array(self.window),packed=np.packbits(self.inside,axis=None))
+      os.replace(tempName,self.cacheName)
+    except OSError:
+      if(os.path.exists(tempName)):
+        os.remove(tempName)
+
+
+  ###########################################
+
+  def cropWindow(self):
+    '''
+    The boundary's window as a
+    rasterio Window
+    '''
+    return(Window(*self.window))
+
+
+  ###########################################
+
+  def cropped(self,shapefile,transform,crs,cacheDir=None):
+    '''
+    The same mask on the grid of a raster
+    cropped to this window, whose affine
+    transform is given. Saved so that
+    later steps reading the cropped raster
+    reuse it without rasterising again
+    '''
+    shape=(self.window[3],self.window[2])
+    key=maskKey(shapefile,transform,shape,crs)
+    mask=_maskCache.get(key)
+    if(mask is None):
+      mask=boundaryMask.__new__(boundaryMask)
+      mask.key=key
+      mask.shape=shape
+      cacheDir=cacheDir if(cacheDir is not None) else os.path.dirname(os.path.abspath(shapefile))
+      mask.cacheName=os.path.join(cacheDir,os.path.splitext(os.path.basename(shapefile))[0]+"."+key[:16]+".mask.npz")
+      mask.window=(0,0,shape[1],shape[0])
+      mask.inside=self.inside
+      if(not os.path.exists(mask.cacheName)):
+        mask.saveMask()
+      _maskCache[key]=mask
+    return(mask)
+
+
+  ###########################################
+
+  def full(self):
+    '''
+    Mask over the whole grid
+    '''
+    out=np.zeros(self.shape,dtype=bool)
+    col0,row0,width,height=self.window
+    out[row0:row0+height,col0:col0+width]=self.inside
+    return(out)
+
+
+  ###########################################
+
+  def block(self,rowOff,colOff,height,width):
+    '''
+    Mask for a window of the whole grid,
+    without making the full grid mask
+    '''
+    out=np.zeros((height,width),dtype=bool)
+    col0,row0,maskWidth,maskHeight=self.window
+    r0=max(rowOff,row0)
+    r1=min(rowOff+height,row0+maskHeight)
+    c0=max(colOff,col0)
+    c1=min(colOff+width,col0+maskWidth)
+    if((r1>r0)and(c1>c0)):
+      out[r0-rowOff:r1-rowOff,c0-colOff:c1-colOff]=self.inside[r0-row0:r1-row0,c0-col0:c1-col0]
+    return(out)
+
+
+  ###########################################
+
+  def apply(self,data,nodata,rowOff=0,colOff=0):
+    '''
+    Set pixels of data outside the boundary
+    to nodata. data is a block of the
+    boundary's window starting at
+    rowOff,colOff
+    '''
+    inside=self.inside[rowOff:rowOff+data.shape[0],colOff:colOff+data.shape[1]]
+    return(np.where(inside,data,nodata).astype(data.dtype,copy=False))
+
+
+###########################################
+
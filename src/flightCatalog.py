@@ -0,0 +1,314 @@
+
+'''
+A catalog of the LVIS files in a campaign
+folder: bounds, shot counts, dates and a
+coarse outline of each flight, kept in a
+single file and refreshed only for files
+that changed, so files outside an area of
+interest are skipped without opening them
+'''
+
+###################################
+import os
+import re
+import json
+import argparse
+from glob import glob
+from datetime import date
+import numpy as np
+from lvisIndex import lvisIndex,fileFingerprint
+import profiler
+
+
+###################################
+
+# catalog file written in the campaign folder
+CATALOG_NAME="lvis_catalog.json"
+
+# projection of the projected bounds and outlines
+CATALOG_EPSG=3031
+
+# layout version, older catalogs are rebuilt
+CATALOG_VERSION=1
+
+# date in names such as ILVIS1B_AQ2015_1014_R1605_070717.h5
+DATE_PATTERN=re.compile(r"_[A-Z]{2}(\d{4})_(\d{2})(\d{2})_")
+
+
+###################################
+
+def flightDate(filename):
+  '''
+  Date of a flight from its file name
+  as YYYY-MM-DD, or None if the name
+  does not contain one
+  '''
+  match=DATE_PATTERN.search(os.path.basename(filename))
+  if(match is None):
+    return(None)
+  try:
+    return(date(*(int(v) for v in match.groups())).isoformat())
+  except ValueError:
+    return(None)
+
+
+###################################
+
+def outline(x,y):
+  '''
+  Convex hull of footprint midpoints, as
+  a list of [x,y] corners. A conservative
+  outline: it never misses a footprint,
+  though it may take in gaps between them
+  '''
+  if(x.shape[0]==0):
+    return([])
+  from scipy.spatial import ConvexHull,QhullError
+  points=np.column_stack((x,y))
+  try:
+    corners=points[ConvexHull(points).vertices]
+  except (QhullError,ValueError):    # too few points, or all in a line
+    x0,y0=np.min(points,axis=0)
+    x1,y1=np.max(points,axis=0)
+    corners=np.array([[x0,y0],[x1,y0],[x1,y1],[x0,y1]])
+  return(corners.tolist())
+
+
+###################################
+
+def convexIntersects(a,b):
+  '''
+  True if two convex polygons, given as
+  (n,2) corner arrays, overlap. Uses the
+  separating axis test on every edge
+  '''
+  a=np.asarray(a,dtype=np.float64)
+  b=np.asarray(b,dtype=np.float64)
+  if((a.shape[0]==0)or(b.shape[0]==0)):
+    return(False)
+  for poly in (a,b):
+    edges=np.roll(poly,-1,axis=0)-poly
+    normals=np.column_stack((-edges[:,1],edges[:,0]))
+    projA=a@normals.T
+    projB=b@normals.T
+    if(np.any((projA.max(axis=0)<projB.min(axis=0))|(projB.max(axis=0)<projA.min(axis=0)))):
+      return(False)
+  return(True)
+
+
+###################################
+
+def boxCorners(bounds):
+  '''
+  Corners of [minX,minY,maxX,maxY]
+  '''
+  return(np.array([[bounds[0],bounds[1]],[bounds[2],bounds[1]],[bounds[2],bounds[3]],[bounds[0],bounds[3]]]))
+
+
+###################################
+
+class flightCatalog(object):
+  '''
+  Per-file summaries of the LVIS files
+  in a folder, by file name: size and
+  modification time, shot and bin counts,
+  date, geographic bounds, EPSG:3031
+  bounds and an EPSG:3031 outline
+  '''
+
+  def __init__(self,folder,catalogName=None,pattern="*.h5"):
+    '''
+    Class initialiser. Loads the catalog
+    and describes any files that are new
+    or changed since it was written
+    '''
+    self.folder=folder
+    self.pattern=pattern
+    self.catalogName=catalogName if(catalogName is not None) else os.path.join(folder,CATALOG_NAME)
+    self.entries={}
+    self.loadCatalog()
+    self.refresh()
+
+
+  ###########################################
+
+  def loadCatalog(self):
+    '''
+    Read the catalog file, if there is a
+    readable one of this layout
+    '''
+    if(not os.path.exists(self.catalogName)):
+      return
+    try:
+      with open(self.catalogName) as f:
+        catalog=json.load(f)
+    except (OSError,ValueError):   # unreadable or partly written
+      return
+    if(catalog.get('version')==CATALOG_VERSION):
+      self.entries=catalog.get('files',{})
+
+
+  ###########################################
+
+  def refresh(self):
+    '''
+    Describe files that are new or whose
+    size or modification time changed,
+    drop those that have gone, and save
+    the catalog if anything changed
+    '''
+    changed=False
+    present=set()
+    with profiler.stage("catalog",folder=self.folder):
+      for filename in sorted(glob(os.path.join(self.folder,self.pattern))):
+        name=os.path.basename(filename)
+        present.add(name)
+        entry=self.entries.get(name)
+        if((entry is None)or(tuple(entry['fingerprint'])!=fileFingerprint(filename))):
+          print("Cataloguing",name)
+          self.entries[name]=self.describe(filename)
+          changed=True
+      for name in set(self.entries)-present:
+        del self.entries[name]
+        changed=True
+    if(changed):
+      self.saveCatalog()
+
+
+  ###########################################
+
+  def describe(self,filename):
+    '''
+    Summary of one file, from its spatial
+    index (built alongside if needed)
+    '''
+    index=lvisIndex(filename)
+    entry={'fingerprint':list(index.fingerprint),'nShots':int(index.nShots),'nBins':int(index.nBins),
+           'date':flightDate(filename),'bounds':None,'bounds3031':None,'outline3031':[]}
+    if(index.nShots>0):
+      x,y=index.projected(CATALOG_EPSG)
+      entry['bounds']=[float(v) for v in index.bounds]
+      entry['bounds3031']=[float(np.min(x)),float(np.min(y)),float(np.max(x)),float(np.max(y))]
+      entry['outline3031']=outline(x,y)
+    return(entry)
+
+
+  ###########################################
+
+  def saveCatalog(self):
+    '''
+    Write the catalog in one go. Read-only
+    folders are skipped and the catalog is
+    kept in memory instead
+    '''
+    tempName=self.catalogName+".tmp"
+    try:
+      with open(tempName,'w') as f:
+        json.dump({'version':CATALOG_VERSION,'epsg':CATALOG_EPSG,'files':self.entries},f,indent=1,sort_keys=True)
+      os.replace(tempName,self.catalogName)
+    except OSError:
+      print("Could not write catalog",self.catalogName)
+      if(os.path.exists(tempName)):
+        os.remove(tempName)
+
+
+  ###########################################
+
+  def files(self,names=None):
+    '''
+    Full paths of the catalogued files,
+    or of names only, in name order
+    '''
+    names=sorted(self.entries) if(names is None) else sorted(names)
+    return([os.path.join(self.folder,name) for name in names])
+
+
+  ###########################################
+
+  def query(self,bounds,epsg=CATALOG_EPSG):
+    '''
+    Files whose footprints may fall in the
+    area [minX,minY,maxX,maxY]. bounds are
+    EPSG:3031 metres, tested against each
+    outline, or lon/lat with epsg=4326,
+    tested against the geographic bounds
+    '''
+    names=[]
+    for name,entry in self.entries.items():
+      if(entry['bounds'] is None):
+        continue
+      if(epsg==4326):
+        b=entry['bounds']
+        if((b[0]<=bounds[2])and(b[2]>=bounds[0])and(b[1]<=bounds[3])and(b[3]>=bounds[1])):
+          names.append(name)
+      elif(epsg==CATALOG_EPSG):
+        if(convexIntersects(entry['outline3031'],boxCorners(bounds))):
+          names.append(name)
+      else:
+        raise ValueError("Catalog queries take EPSG:"+str(CATALOG_EPSG)+" or EPSG:4326 bounds, not EPSG:"+str(epsg))
+    return(self.files(names))
+
+
+  ###########################################
+
+  def queryShapefile(self,shapefile):
+    '''
+    Files whose outline meets any polygon
+    of a boundary shapefile
+    '''
+    from shapely.geometry import Polygon,box   # only needed for shapefile queries
+    from boundaryMask import readBoundary
+    shapes=readBoundary(shapefile,"EPSG:"+str(CATALOG_EPSG))
+    names=[]
+    for name,entry in self.entries.items():
+      if(entry['bounds3031'] is None):
+        continue
+      corners=entry['outline3031']
+      area=Polygon(corners) if(len(corners)>=3) else box(*entry['bounds3031'])
+      if(any(area.intersects(shape) for shape in shapes)):
+        names.append(name)
+    return(self.files(names))
+
+
+  ###########################################
+
+  def summary(self):
+    '''
+    One line per file: name, date,
+    shots and EPSG:3031 bounds
+    '''
+    lines=[]
+    for name in sorted(self.entries):
+      entry=self.entries[name]
+      b=entry['bounds3031']
+      extent="no shots" if(b is None) else "%.0f %.0f %.0f %.0f"%tuple(b)
+      lines.append("%s %s %9d shots  %s"%(name,entry['date'] or "----------",entry['nShots'],extent))
+    return(lines)
+
+
+###################################
+
+def getCmdArgs():
+  '''
+  Get commandline arguments
+  '''
+  p=argparse.ArgumentParser(description=("Catalog the LVIS files in a folder and list those in an area"))
+  p.add_argument("--input",dest="folder",type=str,default='/geos/netdata/oosa/assignment/lvis/2015/',help=("Campaign folder of LVIS HDF5 files"))
+  p.add_argument("--catalog",dest="catalog",type=str,default=None,help=("Catalog file. Defaults to "+CATALOG_NAME+" in the input folder"))
+  p.add_argument("--aoi",dest="aoi",type=float,nargs=4,default=None,metavar=('MINX','MINY','MAXX','MAXY'),help=("Only list files in this EPSG:3031 area"))
+  p.add_argument("--boundary",dest="boundary",type=str,default=None,help=("Only list files meeting this boundary shapefile"))
+  return(p.parse_args())
+
+
+###################################
+
+if __name__=="__main__":
+  '''Main block'''
+  cmd=getCmdArgs()
+  catalog=flightCatalog(cmd.folder,catalogName=cmd.catalog)
+  for line in catalog.summary():
+    print(line)
+  if(cmd.boundary is not None):
+    print("\n".join(catalog.queryShapefile(cmd.boundary)))
+  elif(cmd.aoi is not None):
+    print("\n".join(catalog.query(cmd.aoi)))
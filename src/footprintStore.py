@@ -0,0 +1,192 @@
+
+'''
+A columnar store of per-shot ground
+elevations, so that DEMs can be
+re-gridded without re-processing
+the waveforms
+'''
+
+###################################
+import os
+import json
+import shutil
+import numpy as np
+
+
+###################################
+
+# columns held for every shot and their types
+COLUMNS={'lfid':np.int64,'shotN':np.int64,'lon':np.float64,'lat':np.float64,
+         'x':np.float64,'y':np.float64,'zG':np.float64,'flag':np.uint8}
+
+# quality flag values
+FLAG_GOOD=0
+FLAG_NO_GROUND=1
+
+# folder in a store holding finished tiles until the file is complete
+PARTS_DIR="parts"
+
+
+###################################
+
+def storeName(folder,filename):
+  '''
+  Store location for an LVIS file
+  '''
+  return(os.path.join(folder,os.path.basename(filename)+".fp"))
+
+
+###################################
+
+def partName(path,x0,y0):
+  '''
+  File of the finished tile with
+  corner x0,y0 in the store at path
+  '''
+  return(os.path.join(path,PARTS_DIR,repr(float(x0))+"_"+repr(float(y0))+".npz"))
+
+
+###################################
+
+def footprintColumns(lvis,nodata=-999.0):
+  '''
+  Pull the stored columns out of a tile
+  that has been reprojected (x,y) and
+  had its ground estimated (zG)
+  '''
+  columns={'lfid':lvis.lfid,'shotN':lvis.lShot,'lon':lvis.lon,'lat':lvis.lat,
+           'x':lvis.x,'y':lvis.y,'zG':lvis.zG}
+  columns['flag']=np.where(lvis.zG==nodata,FLAG_NO_GROUND,FLAG_GOOD)
+  return({name:np.asarray(columns[name],dtype=dtype) for name,dtype in COLUMNS.items()})
+
+
+###################################
+
+class footprintStore(object):
+  '''
+  Per-shot products of one LVIS file,
+  one memory-mapped .npy per column
+  '''
+
+  def __init__(self,path):
+    '''
+    Class initialiser. Opens the columns
+    as read-only memory maps
+    '''
+    self.path=path
+    with open(os.path.join(path,"meta.json")) as f:
+      self.meta=json.load(f)
+    self.key=self.meta['key']
+    self.epsg=self.meta['epsg']
+    self.nShots=self.meta['nShots']
+    for name in COLUMNS:
+      setattr(self,name,np.load(os.path.join(path,name+".npy"),mmap_mode='r'))
+
+
+  ###########################################
+
+  def bounds(self):
+    '''
+    Projected bounds of the shots
+    '''
+    if(self.nShots==0):
+      return(None)
+    return([np.min(self.x),np.min(self.y),np.max(self.x),np.max(self.y)])
+
+
+  ###########################################
+
+  @staticmethod
+  def isCurrent(path,key):
+    '''
+    True if a complete store made
+    with this key exists at path
+    '''
+    metaName=os.path.join(path,"meta.json")
+    if(not os.path.exists(metaName)):
+      return(False)
+    with open(metaName) as f:
+      return(json.load(f).get('key')==key)
+
+
+  ###########################################
+
+  @staticmethod
+  def write(path,key,epsg,tiles):
+    '''
+    Write a store from a list of column
+    dictionaries, one per tile, in order.
+    meta.json goes last, so a store cut
+    short by a crash is never read
+    '''
+    os.makedirs(path,exist_ok=True)
+    metaName=os.path.join(path,"meta.json")
+    if(os.path.exists(metaName)):
+      os.remove(metaName)
+    nShots=0
+    for name,dtype in COLUMNS.items():
+      if(len(tiles)>0):
+        column=np.concatenate([tile[name] for tile in tiles]).astype(dtype,copy=False)
+      else:
+        column=np.empty(0,dtype=dtype)
+      np.save(os.path.join(path,name+".npy"),column)
+      nShots=column.shape[0]
+    with open(metaName,'w') as f:
+      json.dump({'key':key,'epsg':epsg,'nShots':nShots,'columns':list(COLUMNS)},f)
+    shutil.rmtree(os.path.join(path,PARTS_DIR),ignore_errors=True)
+
+
+  ###########################################
+
+  @staticmethod
+  def writePart(path,key,x0,y0,columns):
+    '''
+    Save the columns of one finished tile,
+    so a file cut short by a crash resumes
+    from its next tile. Renamed in to place
+    once written, so a part is whole or
+    missing
+    '''
+    name=partName(path,x0,y0)
+    os.makedirs(os.path.dirname(name),exist_ok=True)
+    tempName=name+".tmp"
+    with open(tempName,'wb') as f:
+      np.savez(f,key=key,**columns)
+    os.replace(tempName,name)
+
+
+  ###########################################
+
+  @staticmethod
+  def hasPart(path,key,x0,y0):
+    '''
+    True if the tile with corner x0,y0
+    was finished with this key
+    '''
+    name=partName(path,x0,y0)
+    if(not os.path.exists(name)):
+      return(False)
+    try:
+      with np.load(name) as part:
+        return(str(part['key'])==key)
+    except (OSError,ValueError,KeyError):   # unreadable, rewrite it
+      return(False)
+
+
+  ###########################################
+
+  @staticmethod
+  def merge(path,key,epsg,corners):
+    '''
+    Write the store from the finished tiles
+    with corners [(x0,y0),...], in that
+    order, then drop the parts
+    '''
+    tiles=[]
+    for x0,y0 in corners:
+      with np.load(partName(path,x0,y0)) as part:
+        tiles.append({name:part[name] for name in COLUMNS})
+    footprintStore.write(path,key,epsg,tiles)
+
+
+###########################################
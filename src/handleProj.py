@@ -0,0 +1,61 @@
+
+'''
+Cached coordinate transformations
+shared by the LVIS and tiff classes
+'''
+
+#######################################################
+# import necessary packages
+
+import numpy as np
+from pyproj import Transformer   # package for reprojecting data
+import profiler
+
+
+#######################################################
+
+# transformers already set up, keyed by (inEPSG,outEPSG)
+_transformers={}
+
+
+#######################################################
+
+def getTransformer(inEPSG,outEPSG):
+  '''
+  Return a transformer between two EPSG
+  codes, setting it up only once per
+  process. Coordinates are always in
+  x,y (lon,lat) order
+  '''
+  key=(int(inEPSG),int(outEPSG))
+  if(key not in _transformers):
+    _transformers[key]=Transformer.from_crs("epsg:"+str(key[0]),"epsg:"+str(key[1]),always_xy=True)
+  return(_transformers[key])
+
+
+#######################################################
+
+def reprojectCoords(x,y,inEPSG,outEPSG,outX=None,outY=None):
+  '''
+  Reproject arrays of x,y (lon,lat for
+  geographic systems). Results are
+  written in place in to outX and outY
+  if given, which must be float64
+  arrays the same shape as x and y
+  '''
+  if(outX is None):
+    outX=np.array(x,dtype=np.float64)
+  else:
+    np.copyto(outX,x)
+  if(outY is None):
+    outY=np.array(y,dtype=np.float64)
+  else:
+    np.copyto(outY,y)
+
+  # transform the copies in place
+  with profiler.stage("reproject",shots=outX.size):
+    getTransformer(inEPSG,outEPSG).transform(outX,outY,inplace=True)
+  return(outX,outY)
+
+
+#######################################################
@@ -12,6 +12,7 @@ from osgeo import gdal             # package for handling geotiff data
 from osgeo import osr              # package for handling projection information
 from gdal import Warp
 import numpy as np
+from tiffExample import gridPoints
 
 
 #######################################################
@@ -31,9 +32,11 @@ class tiffHandle():
 
 
   ########################################
-  def writeTiff(data,x,y,res,filename="lvis_image.tif",epsg=4326):
+  def writeTiff(data,x,y,res,filename="lvis_image.tif",epsg=4326,stat="mean",nodata=-999.0):
     '''
-    Make a geotiff from an array of points
+    Make a geotiff from an array of points,
+    combining footprints in the same pixel
+    with stat and skipping nodata footprints
     '''
 
     # determine bounds
@@ -46,16 +49,8 @@ class tiffHandle():
     nX=int((maxX-minX)/res+1)
     nY=int((maxY-minY)/res+1)
 
-    # pack in to array
-    imageArr=np.full((nY,nX),-999.0)        # make an array of missing data flags
-
-    # calculate the raster pixel index in x and y
-    xInds=np.array(np.floor((x-np.min(x))/res),dtype=int)   # need to force to int type
-    yInds=np.array(np.floor((np.max(y)-y)/res),dtype=int)
-    # floor rounds down. y is from top to bottom
-
-    # this is a simple pack which will assign a single footprint to each pixel
-    imageArr[yInds,xInds]=data
+    # pack in to array, combining footprints in the same pixel
+    imageArr,countArr=gridPoints(data,x,y,res,minX,maxY,nX,nY,stat=stat,nodata=nodata)
 
     # set geolocation information (note geotiffs count down from top edge in Y)
     geotransform = (minX, res, 0, maxY, 0, -res)
@@ -68,7 +63,7 @@ class tiffHandle():
     srs.ImportFromEPSG(epsg)                # WGS84 lat/long
     dst_ds.SetProjection(srs.ExportToWkt()) # export coords to file
     dst_ds.GetRasterBand(1).WriteArray(imageArr)  # write image to the raster
-    dst_ds.GetRasterBand(1).SetNoDataValue(-999)  # set no data value
+    dst_ds.GetRasterBand(1).SetNoDataValue(nodata)  # set no data value
     dst_ds.FlushCache()                     # write to disk
     dst_ds = None
 
@@ -7,6 +7,172 @@ with methods to read
 ###################################
 import numpy as np
 import h5py
+from lvisIndex import getIndex,snapTileSize
+from waveCache import getWaveCache,contiguousRows
+import profiler
+
+
+###################################
+
+# float type of elevations and processed waveforms
+# for each precision mode. Waves keep their stored type
+PRECISIONS={'full':np.float64,'compact':np.float32}
+
+
+# waves decoded at a time by decodeElevations
+DECODE_BLOCK=1024
+
+
+###################################
+
+def checkPrecision(precision):
+  '''
+  Raise an error for an unknown
+  precision mode
+  '''
+  if(precision not in PRECISIONS):
+    raise ValueError("Unknown precision "+str(precision)+", choose from "+",".join(PRECISIONS))
+  return(precision)
+
+
+###################################
+
+def readRows(dset,useInd):
+  '''
+  Read only the rows useInd (sorted) of
+  an HDF5 dataset. Neighbouring indices
+  are merged in to contiguous runs, with
+  gaps smaller than a chunk read through
+  as HDF5 would decompress them anyway
+  '''
+  useInd=np.asarray(useInd)
+  out=np.empty((useInd.shape[0],)+dset.shape[1:],dtype=dset.dtype)
+  if(useInd.shape[0]==0):
+    return(out)
+
+  # largest gap worth reading through
+  maxGap=dset.chunks[0] if(dset.chunks is not None) else 1
+
+  # split in to runs wherever the gap is too big
+  breaks=np.where(np.diff(useInd)>maxGap)[0]
+  starts=np.concatenate(([0],breaks+1))
+  ends=np.concatenate((breaks+1,[useInd.shape[0]]))
+
+  # one slice read per run
+  for s,e in zip(starts,ends):
+    i0=useInd[s]
+    i1=useInd[e-1]+1
+    if(i1-i0==e-s):      # every row in the run is wanted
+      dset.read_direct(out,source_sel=np.s_[i0:i1],dest_sel=np.s_[s:e])
+    else:
+      out[s:e]=dset[i0:i1][useInd[s:e]-i0]
+  profiler.record(bytesRead=out.nbytes)
+  return(out)
+
+
+###################################
+
+def decodeElevations(lZ0,lZN,nBins,dtype=np.float64):
+  '''
+  Elevation of every bin for waveforms with
+  top and bottom elevations lZ0 and lZN.
+  Broadcast version of a np.linspace per wave,
+  worked out DECODE_BLOCK waves at a time in
+  to an array of dtype, so a float32 result
+  never needs a full float64 copy
+  '''
+  lZ0=np.asarray(lZ0)
+  lZN=np.asarray(lZN)
+  if(lZ0.ndim==0):
+    return(np.linspace(lZ0,lZN,nBins).astype(dtype,copy=False))
+  z=np.empty(lZ0.shape+(nBins,),dtype=dtype)
+  for i0 in range(0,lZ0.shape[0],DECODE_BLOCK):
+    i1=min(i0+DECODE_BLOCK,lZ0.shape[0])
+    z[i0:i1]=np.linspace(lZ0[i0:i1],lZN[i0:i1],nBins,axis=-1)
+  return(z)
+
+
+###################################
+
+class lazyElevations(object):
+  '''
+  Stand-in for the (nWaves,nBins) elevation
+  array that decodes rows only when indexed
+  '''
+
+  def __init__(self,lZ0,lZN,nBins,dtype=np.float64):
+    '''
+    Class initialiser. Holds only the
+    top and bottom elevation per wave
+    '''
+    self.lZ0=np.asarray(lZ0)
+    self.lZN=np.asarray(lZN)
+    self.nBins=nBins
+    self.dtype=np.dtype(dtype)
+    self.shape=(self.lZ0.shape[0],nBins)
+
+
+  def __len__(self):
+    return(self.shape[0])
+
+
+  def __getitem__(self,key):
+    '''
+    Decode the requested rows, then apply
+    any bin index to the decoded block
+    '''
+    if(not isinstance(key,tuple)):
+      key=(key,)
+    z=decodeElevations(self.lZ0[key[0]],self.lZN[key[0]],self.nBins,dtype=self.dtype)
+    if(len(key)>1):
+      z=z[(Ellipsis,)+key[1:]]
+    return(z)
+
+
+  def __array__(self,dtype=None,copy=None):
+    '''
+    Materialise the full array
+    '''
+    z=decodeElevations(self.lZ0,self.lZN,self.nBins,dtype=self.dtype)
+    if(dtype is not None):
+      z=z.astype(dtype,copy=False)
+    return(z)
+
+
+###################################
+
+class lazyColumn(object):
+  '''
+  Per-shot attribute of lvisData. Set
+  directly when read eagerly, otherwise
+  read from the open file the first time
+  it is used and then kept
+  '''
+
+  def __init__(self,dataset):
+    '''
+    Class initialiser. dataset is the HDF5
+    name, with {last} for the last bin
+    '''
+    self.dataset=dataset
+
+
+  def __set_name__(self,owner,name):
+    self.name=name
+
+
+  def __get__(self,obj,owner=None):
+    if(obj is None):
+      return(self)
+    value=obj.__dict__.get(self.name)
+    if(value is None):
+      value=obj.readColumn(self.dataset.format(last=obj.nBins-1),self.name)
+      obj.__dict__[self.name]=value
+    return(value)
+
+
+  def __set__(self,obj,value):
+    obj.__dict__[self.name]=value
 
 
 ###################################
@@ -16,7 +182,23 @@ class lvisData(object):
   LVIS data handler
   '''
 
-  def __init__(self,filename,setElev=False,minX=-100000000,maxX=100000000,minY=-1000000000,maxY=100000000,onlyBounds=False):
+  # precision mode, see PRECISIONS
+  precision='full'
+
+  # per-shot data, read on first use in lazy mode
+  lfid=lazyColumn('LFID')           # LVIS flight ID number
+  lShot=lazyColumn('SHOTNUMBER')    # the LVIS shot number, a label
+  waves=lazyColumn('RXWAVE')        # the recieved waveforms. The data
+  lZN=lazyColumn('Z{last}')         # The elevation of the waveform bottom
+  lZ0=lazyColumn('Z0')              # The elevation of the waveform top
+
+  # file lazy columns are read from, None once closed or when read eagerly
+  fileHandle=None
+
+  # True if close() closes fileHandle, False if it belongs to another object
+  ownsFile=False
+
+  def __init__(self,filename,setElev=False,minX=-100000000,maxX=100000000,minY=-1000000000,maxY=100000000,onlyBounds=False,useIndex=True,useCache=False,precision='full',lazy=False):
     '''
     Class initialiser. Calls a function
     to read LVIS data within bounds
@@ -24,31 +206,51 @@ class lvisData(object):
     setElev=1 converts LVIS's stop and start
     elevations to arrays of elevation.
     onlyBounds sets "bounds" to the corner of the area of interest
+    useIndex finds the subset from the spatial index
+    saved next to the file, building it if needed
+    useCache maps the waveforms from an
+    uncompressed copy next to the file,
+    exporting it the first time
+    precision='compact' holds elevations and
+    processed waveforms as float32
+    lazy=True keeps the file open and reads
+    lfid, lShot, waves, lZ0 and lZN only when
+    first used. Use it in a with block, or
+    call close() when done
     '''
+    self.precision=checkPrecision(precision)
     # call the file reader and load in to the self
-    self.readLVIS(filename,minX,minY,maxX,maxY,onlyBounds)
+    with profiler.stage("readLVIS",file=filename):
+      self.readLVIS(filename,minX,minY,maxX,maxY,onlyBounds,useIndex=useIndex,useCache=useCache,lazy=lazy)
     if(setElev):     # to save time, only read elev if wanted
       self.setElevations()
 
 
   ###########################################
 
-  def readLVIS(self,filename,minX,minY,maxX,maxY,onlyBounds):
+  def readLVIS(self,filename,minX,minY,maxX,maxY,onlyBounds,useIndex=True,useCache=False,lazy=False):
     '''
     Read LVIS data from file
     '''
-    # open file for reading
-    f=h5py.File(filename,'r')
-    # determine how many bins
-    self.nBins=f['RXWAVE'].shape[1]
-    # read coordinates for subsetting
-    lon0=np.array(f['LON0'])       # longitude of waveform top
-    lat0=np.array(f['LAT0'])       # lattitude of waveform top
-    lonN=np.array(f['LON'+str(self.nBins-1)]) # longitude of waveform bottom
-    latN=np.array(f['LAT'+str(self.nBins-1)]) # lattitude of waveform bottom
-    # find a single coordinate per footprint
-    tempLon=(lon0+lonN)/2.0
-    tempLat=(lat0+latN)/2.0
+    if(useIndex):
+      # footprint midpoints come from the index, not the file
+      index=getIndex(filename)
+      self.nBins=index.nBins
+      tempLon=index.lon
+      tempLat=index.lat
+    else:
+      # open file for reading
+      with h5py.File(filename,'r') as f:
+        # determine how many bins
+        self.nBins=f['RXWAVE'].shape[1]
+        # read coordinates for subsetting
+        lon0=np.array(f['LON0'])       # longitude of waveform top
+        lat0=np.array(f['LAT0'])       # lattitude of waveform top
+        lonN=np.array(f['LON'+str(self.nBins-1)]) # longitude of waveform bottom
+        latN=np.array(f['LAT'+str(self.nBins-1)]) # lattitude of waveform bottom
+      # find a single coordinate per footprint
+      tempLon=(lon0+lonN)/2.0
+      tempLat=(lat0+latN)/2.0
 
     # write out bounds and leave if needed
     if(onlyBounds):
@@ -59,45 +261,292 @@ class lvisData(object):
       return
 
     # dertermine which are in region of interest
-    useInd=np.where((tempLon>=minX)&(tempLon<maxX)&(tempLat>=minY)&(tempLat<maxY))
-    if(len(useInd)>0):
-      useInd=useInd[0]
+    if(useIndex):
+      useInd=index.query(minX,minY,maxX,maxY)
+    else:
+      useInd=np.where((tempLon>=minX)&(tempLon<maxX)&(tempLat>=minY)&(tempLat<maxY))[0]
 
     if(len(useInd)==0):
       print("No data contained in that region")
       self.nWaves=0
       return
 
-    # save the subset of all data
-    self.nWaves=len(useInd)
-    self.lon=tempLon[useInd]
-    self.lat=tempLat[useInd]
-
-    # load sliced arrays, to save RAM
-    self.lfid=np.array(f['LFID'])[useInd]          # LVIS flight ID number
-    self.lShot=np.array(f['SHOTNUMBER'])[useInd]   # the LVIS shot number, a label
-    self.waves=np.array(f['RXWAVE'])[useInd]       # the recieved waveforms. The data
-    self.nBins=self.waves.shape[1]
-    # these variables will be converted to easier variables
-    self.lZN=np.array(f['Z'+str(self.nBins-1)])[useInd]       # The elevation of the waveform bottom
-    self.lZ0=np.array(f['Z0'])[useInd]          # The elevation of the waveform top
-    # close file
-    f.close()
+    # open file for reading
+    cache=getWaveCache(filename) if(useCache) else None
+    if(lazy):
+      # left open for the columns read on first use, until close()
+      f=h5py.File(filename,'r')
+      try:
+        self.loadSubset(f,useInd,tempLon,tempLat,cache=cache,lazy=True)
+      except BaseException:   # close it again, whatever went wrong
+        self.fileHandle=None
+        f.close()
+        raise
+      self.ownsFile=True
+    else:
+      with h5py.File(filename,'r') as f:
+        self.loadSubset(f,useInd,tempLon,tempLat,cache=cache)
     # return to initialiser
     return
 
 
   ###########################################
 
-  def setElevations(self):
+  def loadSubset(self,f,useInd,tempLon,tempLat,tempX=None,tempY=None,cache=None,lazy=False):
+    '''
+    Load the shots useInd from an
+    already open HDF5 file. tempX and
+    tempY are projected coordinates
+    of every shot, if already known.
+    With tempLon None, the midpoints of
+    only these shots are read from f.
+    If a waveCache is given, waves and
+    elevations come from it instead,
+    as views when useInd is one run.
+    With lazy, f is kept and the other
+    per-shot data read from it when used
+    '''
+    with profiler.stage("loadSubset",shots=len(useInd)):
+      # save the subset of all data
+      self.nWaves=len(useInd)
+      self.fileInd=useInd       # position of each shot in the file
+      if(tempLon is None):
+        nBins=f['RXWAVE'].shape[1]
+        self.lon=(readRows(f['LON0'],useInd)+readRows(f['LON'+str(nBins-1)],useInd))/2.0
+        self.lat=(readRows(f['LAT0'],useInd)+readRows(f['LAT'+str(nBins-1)],useInd))/2.0
+      else:
+        self.lon=tempLon[useInd]
+        self.lat=tempLat[useInd]
+      if(tempX is not None):
+        self.x=tempX[useInd]
+        self.y=tempY[useInd]
+
+      self.nBins=f['RXWAVE'].shape[1] if(cache is None) else cache.nBins
+      if(cache is not None):
+        # read-only, zero-copy where possible
+        self.waves=contiguousRows(cache.waves,useInd)
+        self.lZN=contiguousRows(cache.lZN,useInd)
+        self.lZ0=contiguousRows(cache.lZ0,useInd)
+        profiler.record(bytesRead=self.waves.nbytes)   # paged in from the cache
+      if(lazy):
+        self.fileHandle=f
+        return
+
+      # load only the selected rows from disk, to save RAM
+      self.lfid=readRows(f['LFID'],useInd)
+      self.lShot=readRows(f['SHOTNUMBER'],useInd)
+      if(cache is None):
+        self.waves=readRows(f['RXWAVE'],useInd)
+        # these variables will be converted to easier variables
+        self.lZN=readRows(f['Z'+str(self.nBins-1)],useInd)
+        self.lZ0=readRows(f['Z0'],useInd)
+
+
+  ###########################################
+
+  def readColumn(self,dataset,name):
+    '''
+    Read this object's rows of a per-shot
+    dataset from the open file, for
+    lazyColumn
+    '''
+    if(self.fileHandle is None):
+      raise AttributeError(name+" was not read and no LVIS file is held open")
+    if(not self.fileHandle):
+      raise ValueError("Can not read "+name+", the LVIS file has been closed")
+    with profiler.stage("readColumn",shots=self.nWaves,column=name):
+      return(readRows(self.fileHandle[dataset],self.fileInd))
+
+
+  ###########################################
+
+  def subset(self,inds):
+    '''
+    View of the shots inds (positions in
+    this object) sharing its open file.
+    Data already read is sliced, the rest
+    is read only for these shots when
+    first used
+    '''
+    inds=np.asarray(inds)
+    sub=self.__class__.__new__(self.__class__)
+    sub.precision=self.precision
+    sub.fileHandle=self.fileHandle
+    sub.nBins=self.nBins
+    sub.nWaves=inds.shape[0]
+    sub.fileInd=self.fileInd[inds]
+    for name in ('lon','lat','x','y','lfid','lShot','waves','lZ0','lZN','z'):
+      value=self.__dict__.get(name)
+      if(isinstance(value,np.ndarray)):
+        setattr(sub,name,value[inds])
+    return(sub)
+
+
+  ###########################################
+
+  def close(self):
+    '''
+    Close the file held open in lazy mode,
+    if this object opened it, which ends
+    reads by its subsets too. Subsets and
+    tiles only let go of the file. Data
+    already read stays usable
+    '''
+    if(self.fileHandle is not None):
+      if(self.ownsFile):
+        self.fileHandle.close()
+      self.fileHandle=None
+
+
+  def __enter__(self):
+    return(self)
+
+
+  def __exit__(self,*args):
+    self.close()
+    return(False)
+
+
+  ###########################################
+
+  @classmethod
+  def fromIndices(cls,filename,useInd,setElev=False,epsg=None,useCache=False,precision='full'):
+    '''
+    Read the shots with the given sorted
+    indices, as found by the spatial index.
+    Used to hand tiles to worker processes.
+    If epsg is given, x and y are set to
+    the projected footprint coordinates.
+    With useCache, worker processes share
+    the mapped waveforms' pages
+    '''
+    index=getIndex(filename)
+    tempX,tempY=index.projected(epsg) if(epsg is not None) else (None,None)
+    cache=getWaveCache(filename) if(useCache) else None
+    lvis=cls.__new__(cls)
+    lvis.precision=checkPrecision(precision)
+    with h5py.File(filename,'r') as f:
+      lvis.loadSubset(f,np.asarray(useInd),index.lon,index.lat,tempX,tempY,cache=cache)
+    if(setElev):
+      lvis.setElevations()
+    return(lvis)
+
+
+  ###########################################
+
+  @classmethod
+  def readShots(cls,filename,inds=None,shotNumbers=None,setElev=True,useCache=False,precision='full'):
+    '''
+    Read only the given shots, by position
+    in the file (a single index or a list)
+    or by SHOTNUMBER. Nothing else is read
+    or decoded, so one waveform costs a
+    few KB. Shots are held in file order
+    '''
+    with h5py.File(filename,'r') as f:
+      nShots=f['RXWAVE'].shape[0]
+      if(shotNumbers is not None):
+        # find the rows holding the wanted shot numbers
+        shotNumbers=np.atleast_1d(shotNumbers)
+        useInd=np.where(np.isin(f['SHOTNUMBER'][:],shotNumbers))[0]
+        if(useInd.shape[0]==0):
+          raise ValueError("Shot numbers not found in "+filename)
+      else:
+        useInd=np.atleast_1d(inds).astype(int)
+        useInd=np.unique(np.where(useInd<0,useInd+nShots,useInd))   # allow negative indices
+        if((useInd.shape[0]==0)or(useInd[0]<0)or(useInd[-1]>=nShots)):
+          raise IndexError("Waveform index out of range for "+filename+" with "+str(nShots)+" shots")
+      lvis=cls.__new__(cls)
+      lvis.precision=checkPrecision(precision)
+      lvis.loadSubset(f,useInd,None,None,cache=getWaveCache(filename) if(useCache) else None)
+    if(setElev):
+      lvis.setElevations()
+    return(lvis)
+
+
+  ###########################################
+
+  @classmethod
+  def iterTiles(cls,filename,step,minX=None,minY=None,maxX=None,maxY=None,setElev=False,skipTile=None,epsg=None,res=None,useCache=False,precision='full',lazy=False):
+    '''
+    Generator over square tiles of side step,
+    replacing nested np.arange tile loops.
+    The file is opened once and shots are
+    binned in a single pass. Only non-empty
+    tiles are yielded, as instances of this
+    class with tileBounds=[x0,y0,x1,y1].
+    Tiles where skipTile(x0,y0) is True
+    are left out without being read.
+    With epsg and res set, tiles are step
+    metres in that projection, snapped to
+    the res pixel grid, and each tile has
+    its projected x and y already set.
+    useCache reads waves from the
+    memory-mapped waveform cache.
+    With lazy=True the tiles share the open
+    file and read their per-shot data when
+    first used. The generator owns the file
+    and closes it when the loop ends or is
+    stopped, so read what is needed from a
+    tile inside the loop
+    '''
+    checkPrecision(precision)
+    index=getIndex(filename)
+    if(epsg is not None):
+      step=snapTileSize(step,res)
+      tiles=index.projectedTiles(step,res,epsg=epsg)
+      tempX,tempY=index.projected(epsg)
+    else:
+      tiles=index.tiles(step,minX=minX,minY=minY,maxX=maxX,maxY=maxY)
+      tempX,tempY=None,None
+    cache=getWaveCache(filename) if(useCache) else None
+
+    f=h5py.File(filename,'r')
+    try:
+      for x0,y0,useInd in tiles:
+        if((skipTile is not None)and skipTile(x0,y0)):
+          continue
+        tile=cls.__new__(cls)
+        tile.precision=precision
+        tile.tileBounds=[x0,y0,x0+step,y0+step]
+        tile.loadSubset(f,useInd,index.lon,index.lat,tempX,tempY,cache=cache,lazy=lazy)
+        if(setElev):
+          tile.setElevations()
+        yield tile
+    finally:
+      f.close()
+
+
+  ###########################################
+
+  def setElevations(self,dtype=None,lazy=False):
     '''
     Decodes LVIS's RAM efficient elevation
     format and produces an array of
-    elevations per waveform bin
+    elevations per waveform bin, of the
+    precision mode's float type unless
+    dtype is given. np.float32 halves the
+    memory. lazy=True keeps only lZ0 and
+    lZN and decodes rows when self.z is
+    indexed
+    '''
+    if(dtype is None):
+      dtype=self.floatType()
+    with profiler.stage("setElevations",shots=self.nWaves):
+      if(lazy):
+        self.z=lazyElevations(self.lZ0,self.lZN,self.nBins,dtype=dtype)
+      else:
+        self.z=decodeElevations(self.lZ0,self.lZN,self.nBins,dtype=dtype)
+
+
+  ###########################################
+
+  def floatType(self):
+    '''
+    Float type of elevations and processed
+    waveforms in this precision mode
     '''
-    self.z=np.empty((self.nWaves,self.nBins))
-    for i in range(0,self.nWaves):    # loop over waves
-      self.z[i]=np.linspace(self.lZ0[i],self.lZN[i],self.nBins)   # returns an array of floats
+    return(np.dtype(PRECISIONS[self.precision]))
 
 
   ###########################################
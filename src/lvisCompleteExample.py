@@ -8,7 +8,8 @@ LVIS python scripts
 
 from processLVIS import lvisGround   # we are importing the version with
                                      # the ground-finding algorithm
-from pyproj import Proj, transform
+from handleProj import reprojectCoords
+from waveRenderer import renderWaves
 import matplotlib.pyplot as plt
 import argparse
 import numpy as np
@@ -31,6 +32,11 @@ def getCmdArgs():
   # read a string
   p.add_argument("--input",dest="inName",type=str,default='/geos/netdata/oosa/week4/lvis_antarctica/ILVIS1B_AQ2015_1014_R1605_070717.h5',help=("Input filename"))
   p.add_argument("--outRoot",dest="outRoot",type=str,default='waveforms',help=("Output filename root"))
+  # read integers
+  p.add_argument("--perSheet",dest="perSheet",type=int,default=1,help=("Waveforms per PNG, more than 1 makes contact sheets"))
+  p.add_argument("--plotWorkers",dest="plotWorkers",type=int,default=1,help=("Processes used to render waveform plots"))
+  # read a flag
+  p.add_argument("--cacheWaves",dest="cacheWaves",action='store_true',help=("Read waveforms from a memory-mapped copy next to the input, made on first use"))
   # parse the command line into an object
   cmdargs = p.parse_args()
   # return that object from this function
@@ -45,28 +51,31 @@ class plotLVIS(lvisGround):
 
   def reprojectLVIS(self,outEPSG):
     '''A method to reproject the footprint coordinates'''
-    # set projections
-    inProj=Proj("epsg:4326")
-    outProj=Proj("epsg:"+str(outEPSG))
-    # reproject data
-    self.x,self.y=transform(inProj, outProj, self.lat, self.lon)
+    # reuse the x,y arrays if this object has them already
+    outX=getattr(self,'x',None)
+    outY=getattr(self,'y',None)
+    if((outX is None)or(outX.shape!=self.lon.shape)):
+      outX=outY=None
+    # reproject data with a cached transformer, lon,lat order
+    self.x,self.y=reprojectCoords(self.lon,self.lat,4326,outEPSG,outX=outX,outY=outY)
 
 
   def reprojectBounds(self,outEPSG):
     '''A method to reproject the file bounds'''
-    # set projections
-    inProj=Proj("epsg:4326")
-    outProj=Proj("epsg:"+str(outEPSG))
-    # reproject data
-    self.bounds[0,2],self.bounds[1,3]=transform(inProj, outProj, self.bounds[0,2], self.bounds[1,3])
+    # reproject all four corners of the lon,lat box
+    cornerX=np.array([self.bounds[0],self.bounds[2],self.bounds[2],self.bounds[0]])
+    cornerY=np.array([self.bounds[1],self.bounds[1],self.bounds[3],self.bounds[3]])
+    x,y=reprojectCoords(cornerX,cornerY,4326,outEPSG)
+    self.bounds=[np.min(x),np.min(y),np.max(x),np.max(y)]
 
 
-  def plotWaves(self,outRoot="waveform",step=1):
-    '''A method to plot all waveforms'''
+  def plotWaves(self,outRoot="waveform",step=1,perSheet=1,workers=1):
+    '''A method to plot all waveforms.
+       perSheet>1 makes contact sheets of
+       that many waveforms per PNG'''
 
-    # loop over list of waveforms
-    for i in range(0,self.nWaves,step):
-      self.plotWave(i,outRoot=outRoot)
+    # render every step'th waveform on one reused figure
+    renderWaves(self.waves,self.z,range(0,self.nWaves,step),outRoot=outRoot,perSheet=perSheet,workers=workers)
 
 
   def plotWave(self,i,outRoot="waveform"):
@@ -107,28 +116,20 @@ if __name__=="__main__":
   # below, (x0,y0) is the bottom left corner of our tile
   #   (x1,y1) is the top right corner of our tile
 
-  # loop over spatial subsets
-  for x0 in np.arange(b.bounds[0],b.bounds[2],step):  # loop over x tiles
-    x1=x0+step   # the right side of the tile
-    for y0 in np.arange(b.bounds[1],b.bounds[3],step):  # loop over y tiles
-      y1=y0+step  # the top of the tile
+  # loop over spatial subsets. The file is read once and
+  # only tiles containing data are returned
+  for lvis in plotLVIS.iterTiles(filename,step,setElev=True,useCache=cmd.cacheWaves):
+    x0,y0,x1,y1=lvis.tileBounds
 
-      # print the bounds to screen as a sanity check
-      print("Tile between",x0,y0,"to",x1,y1)
+    # print the bounds to screen as a sanity check
+    print("Tile between",x0,y0,"to",x1,y1)
 
-      # read in all data within our spatial subset
-      lvis=plotLVIS(filename,minX=x0,minY=y0,maxX=x1,maxY=y1,setElev=True)
-
-      # check that it contains some data
-      if(lvis.nWaves==0):
-        continue
-
-      # plot up some waveforms using your new method
-      lvis.plotWaves(step=int(lvis.nWaves/100),outRoot=outRoot+".x."+str(x0)+".y."+str(y0))  # this will print 100 waveforms
+    # plot up some waveforms using your new method
+    lvis.plotWaves(step=max(int(lvis.nWaves/100),1),outRoot=outRoot+".x."+str(x0)+".y."+str(y0),perSheet=cmd.perSheet,workers=cmd.plotWorkers)  # this will print 100 waveforms
                                                                                 # updating the filename as it goes
-      # to make a DEM as a geotiff
-      lvis.reprojectLVIS(3031) # reproject the data to local UTM zone
-      lvis.estimateGround()    # find ground elevations
-      outName="lvisDEM.x."+str(x0)+".y."+str(y0)+".tif"  # set output filename
-      lvis.writeDEM(100,outName)                         # write data to a DEM at 100 m resolution
+    # to make a DEM as a geotiff
+    lvis.reprojectLVIS(3031) # reproject the data to local UTM zone
+    lvis.estimateGround()    # find ground elevations
+    outName="lvisDEM.x."+str(x0)+".y."+str(y0)+".tif"  # set output filename
+    lvis.writeDEM(100,outName)                         # write data to a DEM at 100 m resolution
 
@@ -0,0 +1,291 @@
+
+'''
+A grid-bucket spatial index of
+LVIS footprint midpoints, saved
+next to the HDF5 file so that
+subsets can be found without
+re-reading the coordinate arrays
+'''
+
+###################################
+import os
+import numpy as np
+import h5py
+from handleProj import reprojectCoords
+
+
+###################################
+
+# indices already loaded by this process, keyed by filename
+_indexCache={}
+
+
+###################################
+
+def getIndex(filename,nCells=256):
+  '''
+  Return the spatial index for a file,
+  reusing one already loaded by this
+  process if the file is unchanged
+  '''
+  index=_indexCache.get(filename)
+  if((index is None)or(index.fingerprint!=fileFingerprint(filename))):
+    index=lvisIndex(filename,nCells=nCells)
+    _indexCache[filename]=index
+  return(index)
+
+
+###################################
+
+def fileFingerprint(filename):
+  '''
+  Size and modification time of a file,
+  used to spot stale index files
+  '''
+  stat=os.stat(filename)
+  return((stat.st_size,stat.st_mtime_ns))
+
+
+###################################
+
+def snapTileSize(tileSize,res):
+  '''
+  Round a tile size to a whole
+  number of pixels of size res
+  '''
+  return(max(int(round(tileSize/res)),1)*res)
+
+
+###################################
+
+def tileShots(x,y,xStarts,yStarts,step):
+  '''
+  Group shots in to square tiles of side
+  step with corners xStarts,yStarts in a
+  single pass. Returns a list of
+  (x0,y0,useInd) for non-empty tiles,
+  x tiles outermost
+  '''
+  nX=xStarts.shape[0]
+  nY=yStarts.shape[0]
+  if((nX==0)or(nY==0)):
+    return([])
+
+  # tile number of every shot, using the same x0<=x<x0+step
+  # test as the old loops so edge shots land in the same tile
+  ix=np.searchsorted(xStarts,x,side='right')-1
+  iy=np.searchsorted(yStarts,y,side='right')-1
+  inX=(ix>=0)&(x<xStarts[np.maximum(ix,0)]+step)
+  inY=(iy>=0)&(y<yStarts[np.maximum(iy,0)]+step)
+  shots=np.where(inX&inY)[0]
+  tileId=ix[shots]*nY+iy[shots]
+
+  # group shots by tile, keeping file order within a tile
+  order=np.argsort(tileId,kind='stable')
+  shots=shots[order]
+  tileId=tileId[order]
+  uniq,starts=np.unique(tileId,return_index=True)
+  ends=np.append(starts[1:],shots.shape[0])
+
+  return([(xStarts[t//nY],yStarts[t%nY],shots[s:e]) for t,s,e in zip(uniq,starts,ends)])
+
+
+###################################
+
+class lvisIndex(object):
+  '''
+  Grid-bucket index of footprint midpoints
+  '''
+
+  def __init__(self,filename,nCells=256,indexName=None,save=True):
+    '''
+    Class initialiser. Loads the index
+    file if it is up to date, otherwise
+    builds it from the HDF5 file and
+    writes it alongside.
+    nCells sets the number of grid cells
+    along the longest side of the file
+    '''
+    self.filename=filename
+    self.indexName=indexName if(indexName is not None) else filename+".idx.npz"
+    self.fingerprint=fileFingerprint(filename)
+    self.projCoords={}    # reprojected midpoints, by EPSG code
+    if(not self.loadIndex()):
+      self.buildIndex(nCells)
+      if(save):
+        self.saveIndex()
+
+
+  ###########################################
+
+  def buildIndex(self,nCells):
+    '''
+    Read footprint coordinates once and
+    bucket them in to a regular grid
+    '''
+    with h5py.File(self.filename,'r') as f:
+      self.nBins=f['RXWAVE'].shape[1]
+      lon0=np.array(f['LON0'])       # longitude of waveform top
+      lat0=np.array(f['LAT0'])       # lattitude of waveform top
+      lonN=np.array(f['LON'+str(self.nBins-1)]) # longitude of waveform bottom
+      latN=np.array(f['LAT'+str(self.nBins-1)]) # lattitude of waveform bottom
+    # find a single coordinate per footprint
+    self.lon=(lon0+lonN)/2.0
+    self.lat=(lat0+latN)/2.0
+    self.nShots=self.lon.shape[0]
+
+    # grid origin and cell size
+    if(self.nShots>0):
+      self.bounds=np.array([np.min(self.lon),np.min(self.lat),np.max(self.lon),np.max(self.lat)])
+    else:
+      self.bounds=np.zeros(4)
+    width=max(self.bounds[2]-self.bounds[0],self.bounds[3]-self.bounds[1])
+    self.cellSize=width/nCells if(width>0.0) else 1.0
+    self.nX=int((self.bounds[2]-self.bounds[0])/self.cellSize)+1
+    self.nY=int((self.bounds[3]-self.bounds[1])/self.cellSize)+1
+
+    # sort shots by cell, keeping file order within a cell
+    cell=self.cellOf(self.lon,self.lat)
+    self.order=np.argsort(cell,kind='stable')
+    counts=np.bincount(cell,minlength=self.nX*self.nY)
+    self.cellStart=np.concatenate(([0],np.cumsum(counts)))
+
+
+  ###########################################
+
+  def cellOf(self,lon,lat):
+    '''
+    Flat grid cell number of each coordinate
+    '''
+    ix=np.clip(np.floor((lon-self.bounds[0])/self.cellSize).astype(int),0,self.nX-1)
+    iy=np.clip(np.floor((lat-self.bounds[1])/self.cellSize).astype(int),0,self.nY-1)
+    return(iy*self.nX+ix)
+
+
+  ###########################################
+
+  def loadIndex(self):
+    '''
+    Load an index file if it matches
+    the current HDF5 file. Returns
+    False if it needs rebuilding
+    '''
+    if(not os.path.exists(self.indexName)):
+      return(False)
+    try:
+      with np.load(self.indexName) as d:
+        if(tuple(d['fingerprint'])!=self.fingerprint):
+          return(False)
+        self.nBins=int(d['nBins'])
+        self.lon=d['lon']
+        self.lat=d['lat']
+        self.bounds=d['bounds']
+        self.cellSize=float(d['cellSize'])
+        self.nX=int(d['nX'])
+        self.nY=int(d['nY'])
+        self.order=d['order']
+        self.cellStart=d['cellStart']
+    except (OSError,KeyError,ValueError):   # unreadable or old layout
+      return(False)
+    self.nShots=self.lon.shape[0]
+    return(True)
+
+
+  ###########################################
+
+  def saveIndex(self):
+    '''
+    Write the index next to the HDF5 file.
+    Read-only data drives are skipped and
+    the index is kept in memory instead
+    '''
+    tempName=self.indexName+".tmp.npz"
+    try:
+      np.savez(tempName,fingerprint=np.array(self.fingerprint,dtype=np.int64),nBins=self.nBins,
+               lon=self.lon,lat=self.lat,bounds=self.bounds,cellSize=self.cellSize,
+               nX=self.nX,nY=self.nY,order=self.order,cellStart=self.cellStart)
+      os.replace(tempName,self.indexName)
+    except OSError:
+      if(os.path.exists(tempName)):
+        os.remove(tempName)
+
+
+  ###########################################
+
+  def query(self,minX,minY,maxX,maxY):
+    '''
+    Return the sorted shot indices with
+    minX<=lon<maxX and minY<=lat<maxY
+    '''
+    if((self.nShots==0)or(minX>self.bounds[2])or(maxX<self.bounds[0])or(minY>self.bounds[3])or(maxY<self.bounds[1])):
+      return(np.empty(0,dtype=int))
+
+    # range of cells overlapping the box
+    ix0=int(np.clip(np.floor((minX-self.bounds[0])/self.cellSize),0,self.nX-1))
+    ix1=int(np.clip(np.floor((maxX-self.bounds[0])/self.cellSize),0,self.nX-1))
+    iy0=int(np.clip(np.floor((minY-self.bounds[1])/self.cellSize),0,self.nY-1))
+    iy1=int(np.clip(np.floor((maxY-self.bounds[1])/self.cellSize),0,self.nY-1))
+
+    # cells in a grid row are contiguous in the sorted order
+    cand=np.concatenate([self.order[self.cellStart[iy*self.nX+ix0]:self.cellStart[iy*self.nX+ix1+1]] for iy in range(iy0,iy1+1)])
+
+    # exact test on the candidates only
+    lon=self.lon[cand]
+    lat=self.lat[cand]
+    useInd=cand[(lon>=minX)&(lon<maxX)&(lat>=minY)&(lat<maxY)]
+    return(np.sort(useInd))
+
+
+  ###########################################
+
+  def tiles(self,step,minX=None,minY=None,maxX=None,maxY=None):
+    '''
+    Split the shots in to square tiles of side
+    step, laid out from minX,minY as np.arange
+    would. Returns a list of (x0,y0,useInd) for
+    non-empty tiles, x tiles outermost, in one
+    pass over the shots
+    '''
+    # default to the file bounds
+    minX=self.bounds[0] if(minX is None) else minX
+    minY=self.bounds[1] if(minY is None) else minY
+    maxX=self.bounds[2] if(maxX is None) else maxX
+    maxY=self.bounds[3] if(maxY is None) else maxY
+    xStarts=np.arange(minX,maxX,step)
+    yStarts=np.arange(minY,maxY,step)
+    return(tileShots(self.lon,self.lat,xStarts,yStarts,step))
+
+
+  ###########################################
+
+  def projected(self,epsg):
+    '''
+    Footprint midpoints reprojected to
+    EPSG epsg, done once per process
+    '''
+    if(epsg not in self.projCoords):
+      self.projCoords[epsg]=reprojectCoords(self.lon,self.lat,4326,epsg)
+    return(self.projCoords[epsg])
+
+
+  ###########################################
+
+  def projectedTiles(self,tileSize,res,epsg=3031):
+    '''
+    Split the shots in to square tiles in
+    EPSG epsg metres. tileSize is rounded to
+    whole pixels of size res and tile edges
+    sit on multiples of it, so tiles share
+    pixel edges with each other, with the
+    output grid and between files
+    '''
+    tileSize=snapTileSize(tileSize,res)
+    x,y=self.projected(epsg)
+    if(self.nShots==0):
+      return([])
+    xStarts=np.arange(np.floor(np.min(x)/tileSize),np.floor(np.max(x)/tileSize)+1)*tileSize
+    yStarts=np.arange(np.floor(np.min(y)/tileSize),np.floor(np.max(y)/tileSize)+1)*tileSize
+    return(tileShots(x,y,xStarts,yStarts,tileSize))
+
+
+###########################################
@@ -0,0 +1,157 @@
+
+'''
+Write footprints straight in to
+one pre-allocated mosaic geotiff,
+a window at a time
+'''
+
+#######################################################
+# import necessary packages
+
+from osgeo import gdal             # package for handling geotiff data
+from osgeo import osr              # package for handling projection information
+import numpy as np
+from tiffExample import gridPoints
+from overviews import buildOverviews
+import profiler
+
+
+#######################################################
+
+class mosaicWriter(object):
+  '''
+  A geotiff on a fixed grid that tiles
+  write their windows in to directly.
+  Pixels covered by more than one tile
+  are combined with rule, one of mean,
+  min, max, first or last. The footprint
+  count per pixel is kept alongside in
+  <name>_count.tif
+  '''
+
+  def __init__(self,filename,bounds,res,epsg=3031,rule="mean",nodata=-999.0,resume=False):
+    '''
+    Class initialiser. Creates the mosaic
+    covering bounds [minX,minY,maxX,maxY]
+    on a grid snapped to multiples of res,
+    or reopens it if resume is True
+    '''
+    if(rule not in ("mean","min","max","first","last")):
+      raise ValueError("Unknown mosaic rule "+str(rule))
+    self.filename=filename
+    self.countName=filename.rsplit(".tif",1)[0]+"_count.tif"
+    self.res=res
+    self.rule=rule
+    self.nodata=nodata
+
+    # snap the grid to whole pixels
+    self.minX=np.floor(bounds[0]/res)*res
+    self.maxY=np.ceil(bounds[3]/res)*res
+    self.nX=int(np.floor((bounds[2]-self.minX)/res))+1
+    self.nY=int(np.floor((self.maxY-bounds[1])/res))+1
+
+    if(resume):
+      self.ds=gdal.Open(filename,gdal.GA_Update)
+      self.countDs=gdal.Open(self.countName,gdal.GA_Update)
+    else:
+      self.ds=self.createTiff(filename,gdal.GDT_Float32,epsg,nodata)
+      self.countDs=self.createTiff(self.countName,gdal.GDT_UInt32,epsg,0)
+    self.band=self.ds.GetRasterBand(1)
+    self.countBand=self.countDs.GetRasterBand(1)
+
+
+  ########################################
+
+  def createTiff(self,filename,dataType,epsg,fill):
+    '''
+    Make an empty tiled geotiff on the mosaic grid
+    '''
+    dst_ds = gdal.GetDriverByName('GTiff').Create(filename, self.nX, self.nY, 1, dataType, options=['TILED=YES','BIGTIFF=IF_SAFER'])
+    dst_ds.SetGeoTransform((self.minX, self.res, 0, self.maxY, 0, -self.res))    # specify coords
+    srs = osr.SpatialReference()            # establish encoding
+    srs.ImportFromEPSG(epsg)
+    dst_ds.SetProjection(srs.ExportToWkt()) # export coords to file
+    dst_ds.GetRasterBand(1).SetNoDataValue(fill)  # set no data value
+    dst_ds.GetRasterBand(1).Fill(fill)
+    return(dst_ds)
+
+
+  ########################################
+
+  def addPoints(self,data,x,y):
+    '''
+    Grid a tile's footprints and merge
+    them in to the window they cover
+    '''
+    data=np.asarray(data)
+    valid=(data!=self.nodata)&np.isfinite(data)
+    if(not np.any(valid)):
+      return
+    data=data[valid]
+    x=np.asarray(x)[valid]
+    y=np.asarray(y)[valid]
+
+    # pixel window holding this tile
+    xInds=np.floor((x-self.minX)/self.res).astype(int)
+    yInds=np.floor((self.maxY-y)/self.res).astype(int)
+    c0=max(np.min(xInds),0)
+    r0=max(np.min(yInds),0)
+    nX=min(np.max(xInds)+1,self.nX)-c0
+    nY=min(np.max(yInds)+1,self.nY)-r0
+    if((nX<=0)or(nY<=0)):
+      return
+
+    # aggregate the tile on the mosaic grid
+    stat=self.rule if(self.rule in ("min","max")) else "mean"
+    tileArr,tileCount=gridPoints(data,x,y,self.res,self.minX+c0*self.res,self.maxY-r0*self.res,nX,nY,stat=stat,nodata=self.nodata)
+
+    # merge with what is already there
+    oldArr=self.band.ReadAsArray(int(c0),int(r0),int(nX),int(nY)).astype(np.float64)
+    oldCount=self.countBand.ReadAsArray(int(c0),int(r0),int(nX),int(nY)).astype(np.int64)
+    both=(tileCount>0)&(oldCount>0)
+    onlyNew=(tileCount>0)&(oldCount==0)
+    newArr=oldArr.copy()
+    newArr[onlyNew]=tileArr[onlyNew]
+    if(self.rule=="mean"):
+      newArr[both]=(oldArr[both]*oldCount[both]+tileArr[both]*tileCount[both])/(oldCount[both]+tileCount[both])
+    elif(self.rule=="min"):
+      newArr[both]=np.minimum(oldArr[both],tileArr[both])
+    elif(self.rule=="max"):
+      newArr[both]=np.maximum(oldArr[both],tileArr[both])
+    elif(self.rule=="last"):
+      newArr[both]=tileArr[both]
+
+    self.band.WriteArray(newArr,int(c0),int(r0))
+    self.countBand.WriteArray(oldCount+tileCount,int(c0),int(r0))
+    profiler.record(bytesRead=oldArr.size*8,bytesWritten=oldArr.size*8)   # Float32 and UInt32 windows
+
+
+  ########################################
+
+  def flush(self):
+    '''
+    Write everything so far to disk
+    '''
+    self.ds.FlushCache()
+    self.countDs.FlushCache()
+
+
+  ########################################
+
+  def close(self):
+    '''
+    Build overviews, then flush and
+    close the mosaic
+    '''
+    with profiler.stage("mosaicOverviews"):
+      buildOverviews(self.ds)
+      buildOverviews(self.countDs,resampling="nearest")
+      self.flush()
+    self.band=None
+    self.countBand=None
+    self.ds=None
+    self.countDs=None
+    print("Mosaic written to",self.filename)
+
+
+#######################################################
@@ -0,0 +1,67 @@
+
+'''
+Overviews for the rasters the tasks write,
+and decimated preview reads that use them.
+Works with GDAL and rasterio datasets, and
+needs neither to be installed to import
+'''
+
+###################################
+# overview levels stop once the smallest is about this many pixels a side
+MIN_OVERVIEW_SIZE=256
+
+
+###################################
+
+def overviewLevels(nX,nY,minSize=MIN_OVERVIEW_SIZE):
+  '''
+  Overview decimation factors, halving
+  until the smallest level fits in
+  about minSize pixels a side
+  '''
+  levels=[]
+  factor=2
+  while(max(nX,nY)/factor>=minSize/2):
+    levels.append(factor)
+    factor*=2
+  return(levels)
+
+
+###################################
+
+def buildOverviews(ds,resampling="average"):
+  '''
+  Add internal overviews to a raster open
+  for writing, a GDAL dataset or a rasterio
+  one, so previews can read a decimated
+  level instead of the full raster. Nodata
+  pixels are skipped when averaging.
+  resampling is a GDAL method name such as
+  average or nearest
+  '''
+  if(hasattr(ds,'BuildOverviews')):     # GDAL
+    levels=overviewLevels(ds.RasterXSize,ds.RasterYSize)
+    if(len(levels)>0):
+      ds.BuildOverviews(resampling.upper(),levels)
+    return
+  from rasterio.enums import Resampling
+  levels=overviewLevels(ds.width,ds.height)
+  if(len(levels)>0):
+    ds.build_overviews(levels,Resampling[resampling.lower()])
+    ds.update_tags(ns='rio_overview',resampling=resampling.lower())
+
+
+###################################
+
+def previewShape(nX,nY,maxPixels):
+  '''
+  (rows,cols) of a decimated read of at
+  most maxPixels a side, or the full size
+  if the raster is smaller. GDAL reads such
+  a shape from the closest overview level
+  '''
+  scale=max(nX/maxPixels,nY/maxPixels,1)
+  return((max(int(nY/scale),1),max(int(nX/scale),1)))
+
+
+###########################################
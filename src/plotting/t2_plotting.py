@@ -3,6 +3,9 @@ import rasterio
 from rasterio.plot import show
 import matplotlib.pyplot as plt
 import argparse
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))  # the shared modules in src
+from overviews import previewShape
 
 def get_first_tif(directory):
     """
@@ -31,15 +34,14 @@ def get_cmd_args():
 def plot_dem(input_file, output_file):
     """
     Plot the DEM from a GeoTIFF file and save it as an image.
+    Only as many pixels as the figure can show are read.
     """
     with rasterio.open(input_file) as src:
-        # Read the dataset's valid data mask as a ndarray.
-        mask = src.dataset_mask()
         # Extract the easting and northing coordinates
-        easting, northing = src.xy(mask.shape[0]//2, mask.shape[1]//2)
+        easting, northing = src.xy(src.height//2, src.width//2)
         
         fig, ax = plt.subplots(figsize=(10, 10))
-        dem_data = src.read(1)
+        dem_data = src.read(1, out_shape=previewShape(src.width, src.height, int(fig.get_figwidth() * fig.dpi)))
         
         show(dem_data, ax=ax, cmap='terrain', title=f'Digital Elevation Model\nEasting: {easting}m, Northing: {northing}m')
         plt.colorbar(mappable=plt.cm.ScalarMappable(cmap='terrain'), ax=ax, label='Elevation')
@@ -1,24 +1,26 @@
+import os
+import sys
 import rasterio
 import matplotlib.pyplot as plt
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))  # the shared modules in src
+from overviews import previewShape
 
 raster_file = 'src/outputs/t3_outputs/mosaic_2015.tif'
 
+# Figure size in inches and the pixels it can show
+fig_size = 10
+max_pixels = fig_size * plt.rcParams['figure.dpi']
+
 # Open the raster file
 with rasterio.open(raster_file) as src:
-    # Read the data
-    data = src.read(1)
-
-    # Get the affine transformation for the raster
-    transform = src.transform
-    
-    # Calculate the extent of the plotted data using transform
-    (width, height) = data.shape
-    x_start, y_start = transform * (0, 0)
-    x_end, y_end = transform * (width, height)
-    extent = [x_start, x_end, y_end, y_start]
+    # Read a decimated copy matched to the figure size, from the overviews if the file has them
+    data = src.read(1, out_shape=previewShape(src.width, src.height, max_pixels))
+
+    # Calculate the extent of the plotted data from the raster bounds
+    extent = [src.bounds.left, src.bounds.right, src.bounds.bottom, src.bounds.top]
 
     # Plot the data
-    plt.figure(figsize=(10, 10))
+    plt.figure(figsize=(fig_size, fig_size))
     plt.imshow(data, cmap='viridis', extent=extent)  # Use the 'extent' to scale axes
     plt.colorbar(label='Elevation')
     plt.title('Mosaic DEM with Northing and Easting')
@@ -7,10 +7,31 @@ Some example functions for processing LVIS data
 
 import numpy as np
 from lvisClass import lvisData
-from pyproj import Proj, transform
+from handleProj import reprojectCoords
+import profiler
 from scipy.ndimage.filters import gaussian_filter1d 
 
 
+#######################################
+
+def isolatedBins(positive):
+  '''
+  Flag the bins removed by the minimum
+  width test in lvisGround.denoise: positive
+  bins with positive bins somewhere before
+  and after them that are not inside a run
+  of consecutive bins. Works on 2D blocks
+  '''
+  nPos=np.cumsum(positive,axis=1)
+  before=(nPos-positive)>0            # not the first positive bin
+  after=nPos<nPos[:,-1:]              # not the last positive bin
+  prev=np.zeros_like(positive)
+  prev[:,1:]=positive[:,:-1]
+  nxt=np.zeros_like(positive)
+  nxt[:,:-1]=positive[:,1:]
+  return(positive&before&after&~(prev&nxt))
+
+
 #######################################
 
 class lvisGround(lvisData):
@@ -20,22 +41,41 @@ class lvisGround(lvisData):
 
   #######################################################
 
-  def estimateGround(self,threshScale=5,statsLen=10,minWidth=3,smooWidth=0.5):
+  def estimateGround(self,threshScale=5,statsLen=10,minWidth=3,smooWidth=0.5,engine="vectorized",blockSize=4096):
     '''
     Processes waveforms to estimate ground
     Only works for bare Earth. DO NOT USE IN TREES
+    engine="vectorized" works on blocks of blockSize
+    waveforms at once and gives the same zG as
+    engine="loop", the per-waveform version.
+    Noise statistics and denoised waveforms
+    are held in the precision mode's float type
     '''
-    # find noise statistics
-    self.findStats(statsLen=statsLen)
-
-    # set threshold
-    threshold=self.setThreshold(threshScale)
-
-    # remove background
-    self.denoise(threshold,minWidth=minWidth,smooWidth=smooWidth)
-
-    # find centre of gravity of remaining signal
-    self.CofG()
+    if(engine=="loop"):
+      # find noise statistics
+      with profiler.stage("findStats",shots=self.nWaves):
+        self.findStats(statsLen=statsLen)
+
+      # set threshold
+      threshold=self.setThreshold(threshScale)
+
+      # remove background
+      with profiler.stage("denoise",shots=self.nWaves):
+        self.denoise(threshold,minWidth=minWidth,smooWidth=smooWidth)
+
+      # find centre of gravity of remaining signal
+      with profiler.stage("CofG",shots=self.nWaves):
+        self.CofG()
+    elif(engine=="vectorized"):
+      with profiler.stage("findStats",shots=self.nWaves):
+        self.findStatsBatch(statsLen=statsLen)
+      threshold=self.setThreshold(threshScale)
+      with profiler.stage("denoise",shots=self.nWaves):
+        self.denoiseBatch(threshold,minWidth=minWidth,smooWidth=smooWidth,blockSize=blockSize)
+      with profiler.stage("CofG",shots=self.nWaves):
+        self.CofGBatch(blockSize=blockSize)
+    else:
+      raise ValueError("Unknown ground estimation engine "+str(engine))
 
 
   #######################################################
@@ -63,17 +103,35 @@ class lvisGround(lvisData):
         self.zG[i]=np.average(self.z[i],weights=self.denoised[i])  # centre of gravity
 
 
+  #######################################################
+
+  def CofGBatch(self,blockSize=4096):
+    '''
+    Find centre of gravity of denoised
+    waveforms a block at a time
+    '''
+    # allocate space and put no data flags
+    self.zG=np.full((self.nWaves),-999.0)
+
+    # loop over blocks of waves
+    for i0 in range(0,self.nWaves,blockSize):
+      i1=min(i0+blockSize,self.nWaves)
+      weights=self.denoised[i0:i1]
+      use=np.sum(weights,axis=1)>0.0   # avoid empty waveforms (clouds etc)
+      weights=weights[use]
+      z=self.z[i0:i1][use]
+      # weighted mean, summed as np.average does
+      self.zG[i0:i1][use]=np.multiply(z,weights,dtype=np.float64).sum(axis=1)/weights.sum(axis=1,dtype=np.float64)
+
+
   #######################################################
 
   def reproject(self,inEPSG,outEPSG):
     '''
     Reproject footprint coordinates
     '''
-    # set projections
-    inProj=Proj("epsg:"+str(inEPSG))
-    outProj=Proj("epsg:"+str(outEPSG))
-    # reproject data
-    x,y=transform(inProj,outProj,self.lon,self.lat)
+    # reproject data with a cached transformer, lon,lat order
+    x,y=reprojectCoords(self.lon,self.lat,inEPSG,outEPSG)
     self.lon=x
     self.lat=y
 
@@ -86,8 +144,8 @@ class lvisGround(lvisData):
     '''
 
     # make empty arrays
-    self.meanNoise=np.empty(self.nWaves)
-    self.stdevNoise=np.empty(self.nWaves)
+    self.meanNoise=np.empty(self.nWaves,dtype=self.floatType())
+    self.stdevNoise=np.empty(self.nWaves,dtype=self.floatType())
 
     # determine number of bins to calculate stats over
     res=(self.z[0,0]-self.z[0,-1])/self.nBins    # range resolution
@@ -101,20 +159,39 @@ class lvisGround(lvisData):
 
   ##############################################
 
-  def denoise(self,threshold,smooWidth=0.5,minWidth=3):
+  def findStatsBatch(self,statsLen=10):
     '''
-    Denoise waveform data
+    Finds standard deviation and mean of
+    noise for all waveforms at once
+    '''
+    # determine number of bins to calculate stats over
+    res=(self.z[0,0]-self.z[0,-1])/self.nBins    # range resolution
+    noiseBins=int(statsLen/res)   # number of bins within "statsLen"
+
+    # waves stay in their stored type, only the statistics are float
+    dtype=self.floatType()
+    self.meanNoise=np.mean(self.waves[:,0:noiseBins],axis=1,dtype=dtype)
+    self.stdevNoise=np.std(self.waves[:,0:noiseBins],axis=1,dtype=dtype)
+
+
+  ##############################################
+
+  def denoise(self,threshold,smooWidth=0.5,minWidth=3,verbose=False):
+    '''
+    Denoise waveform data. verbose
+    reports progress wave by wave
     '''
 
     # find resolution
     res=(self.z[0,0]-self.z[0,-1])/self.nBins    # range resolution
 
-    # make array for output
-    self.denoised=np.full((self.nWaves,self.nBins),0)
+    # make array for output, float so the smoothed signal is not truncated
+    self.denoised=np.zeros((self.nWaves,self.nBins),dtype=self.floatType())
 
     # loop over waves
     for i in range(0,self.nWaves):
-      print("Denoising wave",i+1,"of",self.nWaves)
+      if(verbose):
+        print("Denoising wave",i+1,"of",self.nWaves)
 
       # subtract mean background noise
       self.denoised[i]=self.waves[i]-self.meanNoise[i]
@@ -133,5 +210,41 @@ class lvisGround(lvisData):
       self.denoised[i]=gaussian_filter1d(self.denoised[i],smooWidth/res)
 
 
-#############################################################
+  ##############################################
+
+  def denoiseBatch(self,threshold,smooWidth=0.5,minWidth=3,blockSize=4096):
+    '''
+    Denoise waveform data a block of
+    waveforms at a time. Each block is
+    worked on in place in the output, with
+    one smoothing buffer shared by all
+    '''
+
+    # find resolution
+    res=(self.z[0,0]-self.z[0,-1])/self.nBins    # range resolution
 
+    # make array for output, float so the smoothed signal is not truncated
+    dtype=self.floatType()
+    self.denoised=np.empty((self.nWaves,self.nBins),dtype=dtype)
+    smoothed=np.empty((min(blockSize,self.nWaves),self.nBins),dtype=dtype)
+
+    # loop over blocks of waves
+    for i0 in range(0,self.nWaves,blockSize):
+      i1=min(i0+blockSize,self.nWaves)
+      block=self.denoised[i0:i1]
+
+      # subtract mean background noise, straight from the stored waves
+      np.subtract(self.waves[i0:i1],self.meanNoise[i0:i1,np.newaxis],out=block)
+
+      # set all values less than threshold to zero
+      block[block<threshold[i0:i1,np.newaxis]]=0.0
+
+      # minimum acceptable width
+      block[isolatedBins(block>0.0)]=0.0
+
+      # smooth
+      gaussian_filter1d(block,smooWidth/res,axis=1,output=smoothed[:i1-i0])
+      block[:]=smoothed[:i1-i0]
+
+
+#############################################################
@@ -0,0 +1,227 @@
+
+'''
+Lightweight per-stage instrumentation.
+Stages record wall and CPU time, bytes
+read and written, shots processed and
+peak RSS, and are written out as a
+Chrome trace. When profiling is off a
+stage is a shared do-nothing object
+'''
+
+###################################
+import os
+import glob
+import json
+import time
+import resource
+import threading
+
+
+###################################
+
+_enabled=False
+_events=[]
+_local=threading.local()   # stack of open stages, per thread
+_traceName=None             # trace file named when profiling was turned on
+_workerTrace=None           # where worker processes leave their events
+
+
+###################################
+
+class _noStage(object):
+  '''
+  What stage() returns when profiling is
+  off, so instrumented code costs one
+  function call and a flag test
+  '''
+  def __enter__(self):
+    return(self)
+
+  def __exit__(self,*args):
+    return(False)
+
+  def add(self,**counts):
+    pass
+
+_NO_STAGE=_noStage()
+
+
+###################################
+
+class _stage(object):
+  '''
+  A timed stage. Counts can be added
+  while it is open with add(), or by
+  record() from code it calls
+  '''
+
+  def __init__(self,name,shots=0,bytesRead=0,bytesWritten=0,args=None):
+    self.name=name
+    self.counts={'shots':shots,'bytesRead':bytesRead,'bytesWritten':bytesWritten}
+    self.args=args
+
+  def __enter__(self):
+    stack=getattr(_local,'stack',None)
+    if(stack is None):
+      stack=_local.stack=[]
+    stack.append(self)
+    self.cpu=time.process_time()
+    self.wall=time.perf_counter_ns()
+    return(self)
+
+  def add(self,**counts):
+    for key,value in counts.items():
+      self.counts[key]=self.counts.get(key,0)+value
+
+  def __exit__(self,*args):
+    end=time.perf_counter_ns()
+    cpu=time.process_time()-self.cpu
+    _local.stack.pop()
+    event={'name':self.name,'ph':'X','ts':self.wall/1e3,'dur':(end-self.wall)/1e3,
+           'pid':os.getpid(),'tid':threading.get_ident(),
+           'args':dict(self.counts,cpu=cpu,maxRssMB=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1e3)}
+    if(self.args):
+      event['args'].update(self.args)
+    _events.append(event)
+    return(False)
+
+
+###################################
+
+def enable(traceName=None):
+  '''
+  Start recording stages. traceName is
+  the trace file that process pools
+  started from here report in to
+  '''
+  global _enabled,_traceName
+  _enabled=True
+  _traceName=traceName
+
+
+###################################
+
+def isEnabled():
+  '''
+  True if stages are being recorded
+  '''
+  return(_enabled)
+
+
+###################################
+
+def stage(name,shots=0,bytesRead=0,bytesWritten=0,**args):
+  '''
+  Context manager timing a stage. Extra
+  keyword arguments, e.g. tile corners,
+  are stored with the event
+  '''
+  if(not _enabled):
+    return(_NO_STAGE)
+  return(_stage(name,shots=shots,bytesRead=bytesRead,bytesWritten=bytesWritten,args=args))
+
+
+###################################
+
+def record(**counts):
+  '''
+  Add counts (shots, bytesRead or
+  bytesWritten) to the innermost open
+  stage of this thread
+  '''
+  if(not _enabled):
+    return
+  stack=getattr(_local,'stack',None)
+  if(stack):
+    stack[-1].add(**counts)
+
+
+###################################
+
+def summary(events=None):
+  '''
+  Totals per stage name: calls, wall and
+  CPU seconds, shots, bytes and the
+  largest peak RSS seen
+  '''
+  totals={}
+  for event in (_events if(events is None) else events):
+    total=totals.setdefault(event['name'],{'calls':0,'wall':0.0,'cpu':0.0,'shots':0,'bytesRead':0,'bytesWritten':0,'maxRssMB':0.0})
+    total['calls']+=1
+    total['wall']+=event['dur']/1e6
+    total['cpu']+=event['args']['cpu']
+    for key in ('shots','bytesRead','bytesWritten'):
+      total[key]+=event['args'].get(key,0)
+    total['maxRssMB']=max(total['maxRssMB'],event['args']['maxRssMB'])
+  return(totals)
+
+
+###################################
+
+def workerInit(traceName):
+  '''
+  Process pool initialiser. Worker events
+  are left next to traceName for
+  writeTrace to collect. Events and open
+  stages inherited from a forked parent
+  are dropped, as the parent writes those
+  '''
+  global _workerTrace
+  del _events[:]
+  _local.stack=[]
+  enable()
+  _workerTrace=traceName
+
+
+###################################
+
+def poolArgs():
+  '''
+  Keyword arguments for a process pool so
+  its workers record stages too, or none
+  if profiling is off
+  '''
+  if((not _enabled)or(_traceName is None)):
+    return({})
+  return({'initializer':workerInit,'initargs':(_traceName,)})
+
+
+###################################
+
+def flushWorker():
+  '''
+  Append this worker's events so far to
+  its part file. Called at the end of
+  each task, as pool workers exit
+  without running atexit handlers
+  '''
+  if((not _enabled)or(_workerTrace is None)or(len(_events)==0)):
+    return
+  with open(_workerTrace+"."+str(os.getpid())+".part",'a') as f:
+    for event in _events:
+      f.write(json.dumps(event)+"\n")
+  del _events[:]
+
+
+###################################
+
+def writeTrace(filename):
+  '''
+  Write all events, including any left by
+  worker processes, as a Chrome trace
+  (chrome://tracing or Perfetto) with a
+  per-stage summary alongside
+  '''
+  events=list(_events)
+  for part in glob.glob(glob.escape(filename)+".*.part"):
+    with open(part) as f:
+      events.extend(json.loads(line) for line in f if line.strip())
+    os.remove(part)
+  events.sort(key=lambda e:e['ts'])
+  with open(filename,'w') as f:
+    json.dump({'traceEvents':events,'displayTimeUnit':'ms','summary':summary(events)},f)
+  print("Profile written to",filename)
+
+
+###########################################
+
@@ -0,0 +1,184 @@
+
+'''
+Synthetic LVIS1B files and DEMs with
+the same layout as the real data, for
+testing and benchmarking away from the
+/geos/netdata drive
+'''
+
+###################################
+import os
+import argparse
+import numpy as np
+import h5py
+
+
+###################################
+
+# default area, Pine Island Glacier
+LVIS_BOUNDS=[-100.5,-75.3,-99.5,-74.9]
+DEM_ORIGIN=[-1620000.0,-240000.0]
+
+# range resolution of a waveform bin (m)
+BIN_SIZE=0.3
+
+# shots generated at a time, to bound memory
+SYNTH_BLOCK=16384
+
+
+###################################
+
+def surface(u,v):
+  '''
+  Smooth synthetic ice surface (m) over
+  coordinates scaled to 0-1
+  '''
+  return(400.0+150.0*np.sin(2.5*u)*np.cos(1.5*v)+60.0*u-40.0*v)
+
+
+###################################
+
+def synthWaves(zG,Z0,nBins,rng,noiseMean=200.0,noiseStd=4.0,amp=600.0,width=2.0):
+  '''
+  Background noise plus a Gaussian ground
+  return at elevation zG, for waveforms
+  whose top bin is at Z0
+  '''
+  bins=np.arange(nBins)
+  groundBin=(Z0-zG)/BIN_SIZE
+  waves=noiseMean+noiseStd*rng.standard_normal((zG.shape[0],nBins))
+  waves+=amp*np.exp(-((bins[np.newaxis,:]-groundBin[:,np.newaxis])**2)/(2.0*width**2))
+  return(np.clip(np.round(waves),0,65535).astype(np.uint16))
+
+
+###################################
+
+def writeSynthLVIS(filename,nShots=10000,nBins=500,bounds=LVIS_BOUNDS,seed=0,chunkRows=256):
+  '''
+  Write an LVIS1B-shaped HDF5 file of
+  nShots waveforms of nBins bins, with
+  the real dataset names (RXWAVE, LON0,
+  LAT0, LON<n-1>, LAT<n-1>, Z0, Z<n-1>,
+  LFID and SHOTNUMBER). RXWAVE is chunked
+  and compressed like the real files.
+  Shots are scattered over bounds
+  [minLon,minLat,maxLon,maxLat] above a
+  smooth surface, so estimateGround
+  recovers a known ground
+  '''
+  rng=np.random.default_rng(seed)
+  last=str(nBins-1)
+  with h5py.File(filename,'w') as f:
+    f.create_dataset('RXWAVE',shape=(nShots,nBins),dtype=np.uint16,chunks=(min(chunkRows,max(nShots,1)),nBins),compression='gzip')
+    for name in ('LON0','LAT0','LON'+last,'LAT'+last,'Z0','Z'+last):
+      f.create_dataset(name,shape=(nShots,),dtype=np.float64)
+    f.create_dataset('LFID',data=np.full(nShots,1014000000+seed,dtype=np.int64))
+    f.create_dataset('SHOTNUMBER',data=np.arange(nShots,dtype=np.int64)+10000000*seed)
+
+    # fill a block at a time
+    for i0 in range(0,nShots,SYNTH_BLOCK):
+      i1=min(i0+SYNTH_BLOCK,nShots)
+      n=i1-i0
+      u=rng.random(n)
+      v=rng.random(n)
+      lon=bounds[0]+u*(bounds[2]-bounds[0])
+      lat=bounds[1]+v*(bounds[3]-bounds[1])
+      zG=surface(u,v)
+      Z0=zG+rng.uniform(0.3,0.6,n)*nBins*BIN_SIZE    # ground part way down the waveform
+      ZN=Z0-(nBins-1)*BIN_SIZE
+      lean=rng.normal(0.0,1e-5,n)    # small off-nadir lean, top to bottom
+      f['LON0'][i0:i1]=lon+lean
+      f['LAT0'][i0:i1]=lat+lean
+      f['LON'+last][i0:i1]=lon-lean
+      f['LAT'+last][i0:i1]=lat-lean
+      f['Z0'][i0:i1]=Z0
+      f['Z'+last][i0:i1]=ZN
+      f['RXWAVE'][i0:i1]=synthWaves(zG,Z0,nBins,rng)
+  return(filename)
+
+
+###################################
+
+def writeSynthDEM(filename,nX=1000,nY=1000,res=100.0,origin=DEM_ORIGIN,epsg=3031,seed=0,gapFrac=0.2,change=0.0,nodata=-999.0):
+  '''
+  Write a float32 DEM of nX by nY pixels
+  of size res with its top left corner at
+  origin. About gapFrac of the pixels are
+  nodata, in scattered pixels and holes.
+  change is added everywhere, so two DEMs
+  from the same seed differ by change
+  '''
+  import rasterio                    # only needed for DEMs
+  from rasterio.transform import from_origin
+  rng=np.random.default_rng(seed)
+  u,v=np.meshgrid(np.linspace(0,1,nX),np.linspace(0,1,nY))
+  dem=(surface(u,v)+change).astype(np.float32)
+
+  # scattered missing pixels, plus a few holes like gaps between flight lines
+  dem[rng.random((nY,nX))<gapFrac/2.0]=nodata
+  for i in range(5):
+    r=rng.integers(0,nY)
+    c=rng.integers(0,nX)
+    dem[r:r+max(nY//20,1),c:c+max(nX//10,1)]=nodata
+
+  profile={'driver':'GTiff','width':nX,'height':nY,'count':1,'dtype':'float32','crs':'EPSG:'+str(epsg),
+           'transform':from_origin(origin[0],origin[1],res,res),'nodata':nodata,'tiled':True,'blockxsize':256,'blockysize':256}
+  with rasterio.open(filename,'w',**profile) as dst:
+    dst.write(dem,1)
+  return(filename)
+
+
+###################################
+
+def writeSynthBoundary(filename,nX=1000,nY=1000,res=100.0,origin=DEM_ORIGIN,epsg=3031):
+  '''
+  Write a boundary shapefile, an ellipse
+  inside a DEM made by writeSynthDEM with
+  the same grid
+  '''
+  import geopandas as gpd            # only needed for boundaries
+  from shapely.geometry import Polygon
+  angle=np.linspace(0,2*np.pi,90)
+  cX=origin[0]+nX*res/2.0
+  cY=origin[1]-nY*res/2.0
+  ring=Polygon(zip(cX+0.45*nX*res*np.cos(angle),cY+0.4*nY*res*np.sin(angle)))
+  gpd.GeoDataFrame({'name':['synthetic']},geometry=[ring],crs='EPSG:'+str(epsg)).to_file(filename)
+  return(filename)
+
+
+###################################
+
+def getCmdArgs():
+  '''
+  Get commandline arguments
+  '''
+  p=argparse.ArgumentParser(description=("Write synthetic LVIS1B files and DEMs"))
+  p.add_argument("--output",dest="output",type=str,default='synthetic',help=("Output folder"))
+  p.add_argument("--nFiles",dest="nFiles",type=int,default=1,help=("Number of LVIS files, each from a different seed"))
+  p.add_argument("--nShots",dest="nShots",type=int,default=10000,help=("Shots per LVIS file"))
+  p.add_argument("--nBins",dest="nBins",type=int,default=500,help=("Bins per waveform"))
+  p.add_argument("--demSize",dest="demSize",type=int,default=0,help=("Also write 2009 and 2015 DEMs of this many pixels a side, with a boundary"))
+  p.add_argument("--res",dest="res",type=float,default=100.0,help=("DEM resolution (m)"))
+  return(p.parse_args())
+
+
+###################################
+
+if __name__=="__main__":
+  '''Main block'''
+  cmd=getCmdArgs()
+  os.makedirs(cmd.output,exist_ok=True)
+
+  # flight lines
+  for seed in range(cmd.nFiles):
+    name=writeSynthLVIS(os.path.join(cmd.output,"ILVIS1B_SYNTH_"+str(seed)+".h5"),nShots=cmd.nShots,nBins=cmd.nBins,seed=seed)
+    print("LVIS file written to",name)
+
+  # a pair of DEMs 5 m apart, and a boundary to clip them
+  if(cmd.demSize>0):
+    for year,change in (("2009",0.0),("2015",-5.0)):
+      name=writeSynthDEM(os.path.join(cmd.output,"dem_"+year+".tif"),nX=cmd.demSize,nY=cmd.demSize,res=cmd.res,seed=int(year),change=change)
+      print("DEM written to",name)
+    name=writeSynthBoundary(os.path.join(cmd.output,"boundary.shp"),nX=cmd.demSize,nY=cmd.demSize,res=cmd.res)
+    print("Boundary written to",name)
+
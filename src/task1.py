@@ -3,6 +3,7 @@ import matplotlib.pyplot as plt
 import numpy as np
 import os
 from lvisClass import lvisData
+import profiler
 
 class plotLVIS(lvisData):
     """
@@ -14,7 +15,7 @@ class plotLVIS(lvisData):
         Plots a single waveform at the specified index and saves it to the given output path.
 
         Parameters:
-        1. 'index' (int): Index of the waveform to plot.
+        1. 'index' (int): Index of the waveform to plot, among the shots held.
         2. 'output_path' (str): Full path to save the output plot image.
         """
         output_directory = os.path.dirname(output_path)
@@ -24,7 +25,7 @@ class plotLVIS(lvisData):
         plt.plot(self.waves[index], self.z[index])
         plt.xlabel('Waveform Return Amplitude')
         plt.ylabel('Elevation (m)')
-        plt.title(f'LVIS Waveform for Index {index}')
+        plt.title(f'LVIS Waveform for Index {self.fileInd[index]}')
         plt.grid(True)
         plt.savefig(output_path)
         plt.close()
@@ -38,21 +39,29 @@ def parse_arguments():
         1. '--input_file' - Will use the default file listed below if user does not specify a desired file to read from.
         2. '--output_file' - Will send the plot to the default folder listed below as 'waveform_plot' unless the user specifies a desired folder/name.
         3. '--waveform_index' Will return the waveform at index 0 unless the user specifies an alternate waveform.
+        4. '--cache_waves' Reads the waveforms from a memory-mapped copy saved next to the input file, made the first time it is used.
+        5. '--profile' Writes the time, memory and bytes read of each stage to a Chrome trace file.
     """
     parser = argparse.ArgumentParser(description="Plot an LVIS waveform.")
     parser.add_argument('--input_file', type=str, default='/geos/netdata/oosa/assignment/lvis/2009/ILVIS1B_AQ2009_1020_R1408_049700.h5', help='Input LVIS file')
     parser.add_argument('--output_file', type=str, default='src/outputs/t1_outputs/waveform_plot.png', help='Output plot file with path')
     parser.add_argument('--waveform_index', type=int, default=0, help='Index of the waveform to plot')
+    parser.add_argument('--cache_waves', action='store_true', help='Use a memory-mapped copy of the waveforms for repeated runs')
+    parser.add_argument('--profile', type=str, default=None, help='Write a per-stage timing trace (Chrome trace JSON) to this file')
     return parser.parse_args()
 
 if __name__ == "__main__":
     # Parse the command-line arguments
     args = parse_arguments()
+    if args.profile:
+        profiler.enable(args.profile)
 
-    # Create an instance of the plotLVIS class
-    lvis = plotLVIS(args.input_file)
-    lvis.setElevations()
+    # Read and decode only the requested waveform rather than the whole file
+    lvis = plotLVIS.readShots(args.input_file, args.waveform_index, useCache=args.cache_waves)
 
-    # Plot a specific waveform
-    lvis.plotWave(args.waveform_index, args.output_file)
+    # Plot the waveform, the only one held
+    with profiler.stage("plotWave"):
+        lvis.plotWave(0, args.output_file)
+    if args.profile:
+        profiler.writeTrace(args.profile)
 
@@ -1,7 +1,12 @@
+import os
 import argparse
 from processLVIS import lvisGround
 from lvisCompleteExample import writeTiff
-from pyproj import Proj, transform
+from handleProj import reprojectCoords
+from lvisIndex import getIndex, tileShots
+from tileCache import makeKey, inputFingerprint
+from footprintStore import footprintStore, footprintColumns, storeName, FLAG_GOOD
+import profiler
 import numpy as np
 
 def getCmdArgs():
@@ -18,6 +23,8 @@ def getCmdArgs():
         7. min-y (float): The maximum x-coordinate you want to choose.
         8. max-x (float): The maximum y-coordinate you want to choose.
         9. step-size (float): The step size you want to take over the image.
+        10. footprint-dir (str): Where the per-shot ground elevations are stored for re-gridding.
+        11. profile (str): Write the time, memory and I/O of each stage to this Chrome trace file.
     '''
     p = argparse.ArgumentParser(description=("An argument parser to define the projection, resolution, bounds, and step size."))
     p.add_argument("--input", dest="inName", type=str, default='/geos/netdata/oosa/assignment/lvis/2009/ILVIS1B_AQ2009_1020_R1408_049700.h5', help=("Input filename"))
@@ -30,6 +37,8 @@ def getCmdArgs():
     p.add_argument("--max-x", dest="max_x", type=float, default=None, help=("Maximum x-coordinate"))
     p.add_argument("--max-y", dest="max_y", type=float, default=None, help=("Maximum y-coordinate"))
     p.add_argument("--step-size", dest="step_size", type=float, default=1.0, help=("Step size for spatial subsets"))
+    p.add_argument("--footprint-dir", dest="footprint_dir", type=str, default=None, help=("Footprint store directory. Defaults to 'footprints' in the output directory"))
+    p.add_argument("--profile", dest="profile", type=str, default=None, help=("Write a per-stage timing trace (Chrome trace JSON) to this file"))
     return p.parse_args()
 
 class plotLVIS(lvisGround):
@@ -40,9 +49,7 @@ class plotLVIS(lvisGround):
 
         - outEPSG: The target coordinate system for reprojection.
         """
-        inProj = Proj("epsg:4326")
-        outProj = Proj("epsg:" + str(outEPSG))
-        self.x, self.y = transform(inProj, outProj, self.lat, self.lon)
+        self.x, self.y = reprojectCoords(self.lon, self.lat, 4326, outEPSG)
 
     def writeDEM(self, outName):
         """
@@ -52,26 +59,53 @@ class plotLVIS(lvisGround):
         """
         writeTiff(self.zG, self.x, self.y, self.resolution, filename=outName, epsg=self.projection)
 
+def buildFootprints(cmd, storePath, key):
+    """
+    Estimate the ground for every tile of the input and write the per-shot results to a footprint store.
+
+    - cmd: The parsed command line arguments.
+    - storePath: Where the store is written.
+    - key: The cache key recorded in the store.
+    """
+    columns = []
+    # iterTiles opens the file once and only returns tiles containing data
+    for lvis in plotLVIS.iterTiles(cmd.inName, cmd.step_size, minX=cmd.min_x, minY=cmd.min_y, maxX=cmd.max_x, maxY=cmd.max_y, setElev=True):
+        x0, y0, x1, y1 = lvis.tileBounds
+        print("Tile between", x0, y0, "to", x1, y1)
+
+        with profiler.stage("tile", shots=lvis.nWaves, x0=x0, y0=y0):
+            lvis.reprojectLVIS(cmd.projection)
+            lvis.estimateGround()
+            columns.append(footprintColumns(lvis))
+    with profiler.stage("writeFootprints"):
+        footprintStore.write(storePath, key, cmd.projection, columns)
+
 if __name__ == "__main__":
     cmd = getCmdArgs()
-    filename = cmd.inName
-    outRoot = cmd.outRoot
-
-    b = plotLVIS(filename, onlyBounds=True)
+    if cmd.profile:
+        profiler.enable(cmd.profile)
     step = cmd.step_size
+    footprintDir = cmd.footprint_dir if cmd.footprint_dir is not None else os.path.join(cmd.output_dir, 'footprints')
 
-    for x0 in np.arange(cmd.min_x or b.bounds[0], cmd.max_x or b.bounds[2], step):
-        x1 = x0 + step
-        for y0 in np.arange(cmd.min_y or b.bounds[1], cmd.max_y or b.bounds[3], step):
-            y1 = y0 + step
-            print("Tile between", x0, y0, "to", x1, y1)
-            lvis = plotLVIS(filename, minX=x0, minY=y0, maxX=x1, maxY=y1, setElev=True)
-            if lvis.nWaves == 0:
-                continue
+    # the waveforms are only processed again if the input or processing settings change,
+    # so a new resolution just re-grids the stored ground elevations
+    storePath = storeName(footprintDir, cmd.inName)
+    key = makeKey(input=inputFingerprint(cmd.inName), epsg=cmd.projection, step=step,
+                  bounds=[cmd.min_x, cmd.min_y, cmd.max_x, cmd.max_y])
+    if not footprintStore.isCurrent(storePath, key):
+        buildFootprints(cmd, storePath, key)
+    store = footprintStore(storePath)
 
-            lvis.reprojectLVIS(cmd.projection)
-            lvis.estimateGround()
+    # split the stored shots into the same tiles in geographic coordinates, laid out from the file bounds
+    if store.nShots > 0:
+        bounds = getIndex(cmd.inName).bounds
+        xStarts = np.arange(bounds[0] if cmd.min_x is None else cmd.min_x, bounds[2] if cmd.max_x is None else cmd.max_x, step)
+        yStarts = np.arange(bounds[1] if cmd.min_y is None else cmd.min_y, bounds[3] if cmd.max_y is None else cmd.max_y, step)
+        for x0, y0, useInd in tileShots(store.lon, store.lat, xStarts, yStarts, step):
+            use = useInd[store.flag[useInd] == FLAG_GOOD]
+            if use.shape[0] == 0:
+                continue
             outName = f"{cmd.output_dir}/lvisDEM.x.{x0}.y.{y0}.tif"
-            lvis.resolution = cmd.resolution  # User passes resolution from command line arguments
-            lvis.projection = cmd.projection  # User passes projection from command line arguments
-            lvis.writeDEM(outName)
\ No newline at end of file
+            writeTiff(store.zG[use], store.x[use], store.y[use], cmd.resolution, filename=outName, epsg=cmd.projection)
+    if cmd.profile:
+        profiler.writeTrace(cmd.profile)
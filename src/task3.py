@@ -1,89 +1,368 @@
 import os
+import shutil
 import argparse
-from glob import glob
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from lvisClass import lvisData
-import osgeo.gdal as gdal
+from lvisIndex import getIndex, snapTileSize, tileShots
+from tileCache import tileCache, makeKey, inputFingerprint
+from mosaicWriter import mosaicWriter
+from flightCatalog import flightCatalog
+from footprintStore import footprintStore, footprintColumns, storeName, FLAG_GOOD, PARTS_DIR
 from lvisCompleteExample import plotLVIS
+import profiler
 import numpy as np
 
+# ground estimation settings, recorded in the cache keys
+GROUND_PARAMS = {"threshScale": 5, "statsLen": 10, "minWidth": 3, "smooWidth": 0.5}
+
+# pixels along the side of each window written to the mosaic, when not set by --tile_size
+GRID_CHUNK = 512
+
+# grid in metres the processing tiles are snapped to. The footprint stores only hold per-shot values and are gridded
+# later by grid_footprints, which snaps its windows to the output resolution, so processing tiles never decide a pixel
+# and do not need the output grid. Keeping them off it means a new --resolution reuses the stores as they are
+TILE_SNAP = 1.0
+
 def getCmdArgs():
     """
     Parse command-line arguments for the DEM processing script.
 
     Parameters:
         1. input_folder (str): Directory containing the input HDF5 files.
-        2. output_folder (str): Directory where the output DEMs will be saved.
+        2. output_folder (str): Directory where the output mosaic will be saved.
         3. step_divisor (int): Divisor to determine the step size for processing.
         4. resolution (int): Spatial resolution for the output DEMs.
+        5. workers (int): Number of processes used to build tiles in parallel.
+        6. rebuild (bool): Ignore previously built footprints and mosaics and make them again.
+        7. overlap_rule (str): How pixels covered by more than one tile are combined.
+        8. tile_size (float): Tile size in EPSG:3031 metres, replacing step_divisor tiling in degrees.
+        9. footprint_folder (str): Directory for the per-shot ground elevation stores.
+        10. profile (str): Write per-stage timings, bytes, shot counts and peak memory to this Chrome trace file.
+        11. precision (str): 'compact' holds elevations and processed waveforms as float32, halving tile memory.
+        12. aoi (list): Only process files with footprints in this EPSG:3031 area, minX minY maxX maxY.
+        13. boundary_shapefile (str): Only process files with footprints meeting this boundary.
+        14. catalog (str): Catalog file of the input folder's flights.
     """
 
     parser = argparse.ArgumentParser(description="Process LVIS files into DEM and mosaic into a single GeoTIFF.")
     parser.add_argument("--input_folder", type=str, default='/geos/netdata/oosa/assignment/lvis/2015/', help="Input folder containing HDF5 files")
-    parser.add_argument("--output_folder", type=str, default='src/outputs/t3_outputs', help="Output folder for individual DEM GeoTIFFs and final mosaic")
+    parser.add_argument("--output_folder", type=str, default='src/outputs/t3_outputs', help="Output folder for the final mosaic")
     parser.add_argument("--mosaic_name", type=str, default='mosaic_2015', help="Base name for the output mosaic files")
     parser.add_argument("--step_divisor", type=int, default=16, help="Divisor for the step size to split the input files into tiles")
     parser.add_argument("--resolution", type=int, default=200, help="Resolution for the output DEM")
+    parser.add_argument("--workers", type=int, default=1, help="Number of worker processes for tile processing")
+    parser.add_argument("--rebuild", action="store_true", help="Rebuild the footprints and the mosaic even if cached outputs are up to date")
+    parser.add_argument("--overlap_rule", type=str, default='mean', choices=['mean', 'min', 'max', 'first', 'last'], help="How overlapping tiles are combined in the mosaic")
+    parser.add_argument("--tile_size", type=float, default=None, help="Tile size in EPSG:3031 metres, snapped to whole pixels. Replaces --step_divisor tiling in degrees")
+    parser.add_argument("--footprint_folder", type=str, default=None, help="Folder for per-shot ground elevation stores. Defaults to 'footprints' in the output folder")
+    parser.add_argument("--precision", type=str, default='full', choices=['full', 'compact'], help="Float precision of elevations and processed waveforms. 'compact' uses float32, so larger tiles fit in memory")
+    parser.add_argument("--aoi", type=float, nargs=4, default=None, metavar=('MINX', 'MINY', 'MAXX', 'MAXY'), help="Only process files with footprints in this EPSG:3031 area")
+    parser.add_argument("--boundary_shapefile", type=str, default=None, help="Only process files with footprints meeting this boundary shapefile")
+    parser.add_argument("--catalog", type=str, default=None, help="Catalog of the input folder's files. Defaults to 'lvis_catalog.json' in the input folder")
+    parser.add_argument("--profile", type=str, default=None, help="Write a per-stage and per-tile timing trace (Chrome trace JSON) to this file")
     return parser.parse_args()
 
-def process_files_to_dem(input_folder, output_folder, step_divisor, resolution):
+def footprint_key(file, step_divisor, tile_size, precision='full'):
+    """
+    Cache key for a file's footprint store: the input file fingerprint, projection, tiling
+    and ground estimation settings, including the precision. The output resolution is not part of it.
+    """
+    tiling = {"tile_size": tile_size} if tile_size is not None else {"step_divisor": step_divisor}
+    return makeKey(input=inputFingerprint(file), epsg=3031, tiling=tiling, ground=dict(GROUND_PARAMS, precision=precision))
+
+def file_tiles(file, step_divisor, tile_size):
+    """
+    List the non-empty processing tiles of a file as (x0, y0, use_ind).
+
+    Tiles are tile_size metres in EPSG:3031 if tile_size is given, otherwise step_divisor tiles across in degrees.
     """
-    Process LVIS HDF5 files into DEMs and store them in the specified output folder.
+    index = getIndex(file)
+    if tile_size is not None:
+        return index.projectedTiles(tile_size, TILE_SNAP, epsg=3031)
+    step = (index.bounds[2] - index.bounds[0]) / step_divisor
+    return index.tiles(step)
 
-    Iterates through files in the input folder, converts each to a DEM based on the specified resolution and tiling strategy,
-    and saves them to the output folder for later mosaic creation.
+def process_tile(file, x0, y0, use_ind, projected=False, precision='full'):
+    """
+    Estimate ground elevations for one tile. Runs inside a worker process.
 
     Parameters:
-        1. input_folder (str): Directory containing the input HDF5 files.
-        2. output_folder (str): Directory where the output DEMs will be saved.
+        1. file (str): The HDF5 file the tile comes from.
+        2. x0, y0 (float): Bottom left corner of the tile.
+        3. use_ind (numpy.ndarray): Sorted shot indices within the tile.
+        4. projected (bool): Take the EPSG:3031 coordinates from the spatial index rather than reprojecting the tile.
+        5. precision (str): Precision mode of the tile, 'full' or 'compact'.
+
+    Returns the tile's footprint columns (shot labels, coordinates, ground elevation and quality flag).
+    """
+    with profiler.stage("tile", shots=len(use_ind), file=os.path.basename(file), x0=x0, y0=y0):
+        if projected:
+            lvis = plotLVIS.fromIndices(file, use_ind, setElev=True, epsg=3031, precision=precision)
+        else:
+            lvis = plotLVIS.fromIndices(file, use_ind, setElev=True, precision=precision)
+            lvis.reprojectLVIS(3031)  # reprojects the data to EPSG:3031
+        lvis.estimateGround(**GROUND_PARAMS)
+        columns = footprintColumns(lvis)
+    profiler.flushWorker()  # hand this worker's timings to the main process
+    return columns
+
+def build_footprints(file_list, footprint_folder, step_divisor, tile_size=None, workers=1, rebuild=False, precision='full'):
+    """
+    Run the waveform processing for every file whose footprint store is missing or out of date.
+
+    Each file's per-shot ground elevations are written once to a columnar store, so changing the output resolution
+    does not repeat any waveform processing. Every finished tile is saved as a part of its file's store, so a run cut
+    short part way through a file only redoes the tiles that were not finished. With more than one worker, every
+    (file, tile) pair is sent to a process pool, largest tiles first so the footprint counts balance across processes,
+    and a file's store is written as soon as all of its tiles are back. Tiles are always stored in the serial order,
+    so the stores match a serial run.
+
+    Parameters:
+        1. file_list (list): The HDF5 files to process.
+        2. footprint_folder (str): Directory holding the stores.
         3. step_divisor (int): Divisor to determine the step size for processing.
-        4. resolution (int): Spatial resolution for the output DEMs.
+        4. tile_size (float): Processing tile size in EPSG:3031 metres, or None to tile in degrees.
+        5. workers (int): Number of worker processes, 1 to run serially.
+        6. rebuild (bool): Reprocess every file even if its store is up to date.
+        7. precision (str): 'full' or 'compact' (float32) elevations and processed waveforms.
+
+    Returns the list of store paths, one per file.
     """
-    file_list = glob(input_folder + '/*.h5') # glob pullfiles from input_folder with a suffix of .h5
+    os.makedirs(footprint_folder, exist_ok=True)
+    projected = tile_size is not None
+    store_list = [storeName(footprint_folder, file) for file in file_list]
+    key_list = [footprint_key(file, step_divisor, tile_size, precision) for file in file_list]
+    todo = [i for i in range(len(file_list)) if rebuild or not footprintStore.isCurrent(store_list[i], key_list[i])]
+    if rebuild:
+        for i in todo:
+            shutil.rmtree(os.path.join(store_list[i], PARTS_DIR), ignore_errors=True)
+
+    def is_finished(i, x0, y0):
+        return footprintStore.hasPart(store_list[i], key_list[i], x0, y0)
+
+    def write_store(i):
+        corners = [(x0, y0) for x0, y0, use_ind in file_tiles(file_list[i], step_divisor, tile_size)]
+        with profiler.stage("writeFootprints", file=os.path.basename(file_list[i])):
+            footprintStore.merge(store_list[i], key_list[i], 3031, corners)
+        print("Footprints written to", store_list[i])
 
-    for file in file_list[:]:  # Processing all images.
-        b = plotLVIS(file, onlyBounds=True)
-        step = (b.bounds[2] - b.bounds[0]) / step_divisor
-        
-        for x0 in np.arange(b.bounds[0], b.bounds[2], step):
-            x1 = x0 + step
-            for y0 in np.arange(b.bounds[1], b.bounds[3], step):
-                y1 = y0 + step
+    if workers <= 1:
+        for i in todo:  # Processing all out of date images.
+            file = file_list[i]
+            if projected:
+                tiles = plotLVIS.iterTiles(file, tile_size, setElev=True, epsg=3031, res=TILE_SNAP, precision=precision,
+                                           skipTile=lambda x0, y0: is_finished(i, x0, y0))
+            else:
+                bounds = getIndex(file).bounds
+                step = (bounds[2] - bounds[0]) / step_divisor
+                tiles = plotLVIS.iterTiles(file, step, setElev=True, precision=precision,
+                                           skipTile=lambda x0, y0: is_finished(i, x0, y0))
+
+            # one pass over the file, skipping tiles with no footprints or finished by an earlier run
+            for lvis in tiles:
+                x0, y0, x1, y1 = lvis.tileBounds
                 print("Tile between", x0, y0, "to", x1, y1)
 
-                lvis = plotLVIS(file, minX=x0, minY=y0, maxX=x1, maxY=y1, setElev=True)
-                if lvis.nWaves == 0:
-                    continue
+                with profiler.stage("tile", shots=lvis.nWaves, file=os.path.basename(file), x0=x0, y0=y0):
+                    if not projected:
+                        lvis.reprojectLVIS(3031)  # reprojects the data to EPSG:3031
+                    lvis.estimateGround(**GROUND_PARAMS)
+                    footprintStore.writePart(store_list[i], key_list[i], x0, y0, footprintColumns(lvis))
+            write_store(i)
+        return store_list
+
+    # list every non-empty tile of every out of date file not finished by an earlier run as a work unit
+    work_units = []
+    for i in todo:
+        for x0, y0, use_ind in file_tiles(file_list[i], step_divisor, tile_size):
+            if not is_finished(i, x0, y0):
+                work_units.append((file_list[i], x0, y0, use_ind, projected, precision, i))
+    remaining = {i: 0 for i in todo}
+    for unit in work_units:
+        remaining[unit[6]] += 1
+
+    # files without footprints, or with every tile already finished, are stored straight away
+    for i in todo:
+        if remaining[i] == 0:
+            write_store(i)
+
+    # biggest tiles first, so no process is left with a large tile at the end
+    order = sorted(range(len(work_units)), key=lambda u: len(work_units[u][3]), reverse=True)
 
-                lvis.reprojectLVIS(3031)  # reprojects the data to EPSG:3031
-                lvis.estimateGround()
-                outName = os.path.join(output_folder, f"lvisDEM.x.{x0}.y.{y0}.tif")
-                lvis.writeDEM(resolution, outName)
+    with ProcessPoolExecutor(max_workers=workers, **profiler.poolArgs()) as pool:
+        futures = {pool.submit(process_tile, *work_units[u][:6]): u for u in order}
+        for future in as_completed(futures):
+            u = futures[future]
+            x0, y0, i = work_units[u][1], work_units[u][2], work_units[u][6]
+            print("Finished tile", x0, y0)
+            footprintStore.writePart(store_list[i], key_list[i], x0, y0, future.result())
+            remaining[i] -= 1
+            if remaining[i] == 0:
+                # all tiles of this file are back, store them in serial order
+                write_store(i)
+    return store_list
 
-def create_mosaic(output_folder, mosaic_name):
+def mosaic_bounds(store_list):
     """
-    Create a mosaic from individual DEM GeoTIFFs located in the output folder.
+    Find the EPSG:3031 bounds covering the footprints in every store.
 
-    Uses GDAL to compile the generated DEM tiles into a single VRT and then converts it to a GeoTIFF.
+    Parameters:
+        1. store_list (list): Open footprintStore objects.
+
+    Returns [minX, minY, maxX, maxY] in metres.
+    """
+    bounds = np.array([store.bounds() for store in store_list if store.nShots > 0])
+    return [np.min(bounds[:, 0]), np.min(bounds[:, 1]), np.max(bounds[:, 2]), np.max(bounds[:, 3])]
+
+def create_mosaic(output_folder, mosaic_name, bounds, resolution, overlap_rule='mean', resume=False):
+    """
+    Create the mosaic GeoTIFF once, on a fixed EPSG:3031 grid covering the given bounds.
+
+    Footprints are written straight into it window by window, so no per-tile GeoTIFFs or VRT are needed.
 
     Parameters:
-        1. output_folder (str): Directory containing the individual DEM GeoTIFFs.
+        1. output_folder (str): Directory where the mosaic will be saved.
         2. mosaic_name (str): Base name for the output mosaic file.
+        3. bounds (list): [minX, minY, maxX, maxY] in EPSG:3031 metres.
+        4. resolution (int): Spatial resolution of the mosaic.
+        5. overlap_rule (str): How pixels covered by more than one file are combined.
+        6. resume (bool): Reopen an unfinished mosaic instead of starting a new one.
+
+    Returns the open mosaicWriter.
+    """
+    mosaic_file = f'{os.path.join(output_folder, mosaic_name)}.tif'
+    return mosaicWriter(mosaic_file, bounds, resolution, epsg=3031, rule=overlap_rule, resume=resume)
+
+def grid_footprints(store_paths, output_folder, mosaic_name, resolution, overlap_rule='mean', tile_size=None, cache=None):
+    """
+    Grid the stored footprints of every file into the mosaic at the given resolution.
+
+    Only footprints with a ground estimate are used. Each store is written in square windows of tile_size metres
+    (or GRID_CHUNK pixels), snapped to the pixel grid, so memory stays bounded. The cache records which files are
+    already in the mosaic, so an interrupted run carries on and a re-run with unchanged inputs does nothing. A file is
+    marked as started before its first window is written, and if a run stopped part way through one the mosaic is
+    rebuilt from scratch, as windows already flushed for it would otherwise be added twice.
+
+    Parameters:
+        1. store_paths (list): Footprint stores to grid.
+        2. output_folder (str): Directory where the mosaic will be saved.
+        3. mosaic_name (str): Base name for the output mosaic file.
+        4. resolution (int): Spatial resolution of the mosaic.
+        5. overlap_rule (str): How pixels covered by more than one file are combined.
+        6. tile_size (float): Window size in metres, or None for GRID_CHUNK pixels.
+        7. cache (tileCache): Manifest of finished work. Defaults to one in the output folder.
     """
-    input_folder = output_folder
-    mosaic_tifs = glob(input_folder + '/*.tif') # glob pulls all files in input_folder with .tif as suffix
+    mosaic_file = f'{os.path.join(output_folder, mosaic_name)}.tif'
+    if cache is None:
+        cache = tileCache(output_folder)
+    store_list = [footprintStore(path) for path in store_paths]
+    if not any(store.nShots > 0 for store in store_list):
+        print("No footprints to grid, mosaic", mosaic_file, "not written")
+        return
+
+    # the mosaic depends on every store and the gridding settings
+    key = makeKey(stores=[store.key for store in store_list], resolution=resolution, overlap_rule=overlap_rule, tile_size=tile_size)
+    if cache.lookup(key, mosaic_file):
+        print("Mosaic", mosaic_file, "is up to date")
+        return
 
-    vrt_options = gdal.BuildVRTOptions(resolution='highest') # Creates a virtual raster to align the individual rasters
-    vrt_ds = gdal.BuildVRT(f"{os.path.join(output_folder, mosaic_name)}.vrt", mosaic_tifs, options=vrt_options)
+    resume = cache.begin(key, mosaic_file)
+    if resume and any(cache.partDone(mosaic_file, "started:" + store.key) and not cache.partDone(mosaic_file, store.key)
+                      for store in store_list):
+        # some of that file's windows may already be on disk, and adding them again would count them twice
+        print("Mosaic", mosaic_file, "was interrupted part way through a file, rebuilding it")
+        cache.restart(key, mosaic_file)
+        resume = False
+    mosaic = create_mosaic(output_folder, mosaic_name, mosaic_bounds(store_list), resolution, overlap_rule=overlap_rule, resume=resume)
+    window = snapTileSize(tile_size, resolution) if tile_size is not None else GRID_CHUNK * resolution
 
-    # Convert virtual raster to a single TIFF file
-    gdal.Translate(f'{os.path.join(output_folder, mosaic_name)}.tif', vrt_ds)
+    for store in store_list:
+        if cache.partDone(mosaic_file, store.key):
+            continue
+        cache.storePart(mosaic_file, "started:" + store.key)
+        good = np.where(store.flag == FLAG_GOOD)[0]
+        if good.shape[0] > 0:
+            x = store.x[good]
+            y = store.y[good]
+            zG = store.zG[good]
+            xStarts = np.arange(np.floor(np.min(x) / window), np.floor(np.max(x) / window) + 1) * window
+            yStarts = np.arange(np.floor(np.min(y) / window), np.floor(np.max(y) / window) + 1) * window
+            for x0, y0, use in tileShots(x, y, xStarts, yStarts, window):
+                with profiler.stage("mosaicWindow", shots=len(use), x0=x0, y0=y0):
+                    mosaic.addPoints(zG[use], x[use], y[use])
+        mosaic.flush()  # on disk before it is recorded as done
+        cache.storePart(mosaic_file, store.key)
+        print("Gridded", store.path)
+
+    mosaic.close()
+    cache.store(key, mosaic_file)
+
+def process_files_to_dem(input_folder, output_folder, step_divisor, resolution, mosaic_name='mosaic', workers=1, cache=None,
+                         overlap_rule='mean', tile_size=None, footprint_folder=None, rebuild=False, precision='full',
+                         aoi=None, boundary_shapefile=None, catalog_file=None):
+    """
+    Process LVIS HDF5 files into a DEM mosaic in the specified output folder.
+
+    First makes (or reuses) a footprint store of per-shot ground elevations for every file, then grids the stores
+    into the mosaic. Re-running at another resolution only repeats the gridding.
+
+    Files are listed from the folder's flight catalog, which is only refreshed for new or changed files. With an aoi
+    or boundary_shapefile, files whose outline misses it are skipped without being opened.
+
+    If tile_size is given, footprints are reprojected once per file and tiled in EPSG:3031 metres, and the mosaic is
+    written in windows of the same size, snapped to the pixel grid. Otherwise each file is split into step_divisor
+    tiles across in degrees.
+
+    Parameters:
+        1. input_folder (str): Directory containing the input HDF5 files.
+        2. output_folder (str): Directory where the mosaic will be saved.
+        3. step_divisor (int): Divisor to determine the step size for processing.
+        4. resolution (int): Spatial resolution for the output DEMs.
+        5. mosaic_name (str): Base name for the output mosaic file.
+        6. workers (int): Number of worker processes, 1 to run serially.
+        7. cache (tileCache): Manifest of finished work. Defaults to one in the output folder.
+        8. overlap_rule (str): How pixels covered by more than one file are combined.
+        9. tile_size (float): Tile size in EPSG:3031 metres, or None to tile in degrees.
+        10. footprint_folder (str): Directory for the footprint stores. Defaults to 'footprints' in the output folder.
+        11. rebuild (bool): Reprocess every file even if its footprint store is up to date.
+        12. precision (str): 'compact' processes waveforms in float32, for about half the memory per tile.
+        13. aoi (list): [minX, minY, maxX, maxY] in EPSG:3031 metres, or None.
+        14. boundary_shapefile (str): Boundary whose flights are processed, or None.
+        15. catalog_file (str): Catalog file. Defaults to 'lvis_catalog.json' in the input folder.
+    """
+    catalog = flightCatalog(input_folder, catalogName=catalog_file)  # the .h5 files in input_folder
+    if boundary_shapefile is not None:
+        file_list = catalog.queryShapefile(boundary_shapefile)
+    elif aoi is not None:
+        file_list = catalog.query(aoi)
+    else:
+        file_list = catalog.files()
+    print(len(file_list), "of", len(catalog.entries), "files to process")
+    if len(file_list) == 0:
+        print("No input files in", input_folder, "match the area, nothing to do")
+        return
+    if footprint_folder is None:
+        footprint_folder = os.path.join(output_folder, 'footprints')
+
+    store_paths = build_footprints(file_list, footprint_folder, step_divisor, tile_size=tile_size, workers=workers, rebuild=rebuild,
+                                   precision=precision)
+    grid_footprints(store_paths, output_folder, mosaic_name, resolution, overlap_rule=overlap_rule, tile_size=tile_size, cache=cache)
 
 if __name__ == "__main__":
     args = getCmdArgs()
-    
+
     # Making sure output directory actually exists
     os.makedirs(args.output_folder, exist_ok=True)
-    
-    # Creating a mosaic
-    process_files_to_dem(args.input_folder, args.output_folder, args.step_divisor, args.resolution)
-    create_mosaic(args.output_folder, args.mosaic_name)
+    if args.profile:
+        profiler.enable(args.profile)
+
+    # Footprints and mosaics already built with the same inputs and settings are reused
+    cache = tileCache(args.output_folder, enabled=not args.rebuild)
+
+    # Creating a mosaic from the per-shot ground elevations
+    process_files_to_dem(args.input_folder, args.output_folder, args.step_divisor, args.resolution, mosaic_name=args.mosaic_name,
+                         workers=args.workers, cache=cache, overlap_rule=args.overlap_rule, tile_size=args.tile_size,
+                         footprint_folder=args.footprint_folder, rebuild=args.rebuild, precision=args.precision,
+                         aoi=args.aoi, boundary_shapefile=args.boundary_shapefile, catalog_file=args.catalog)
+    if args.profile:
+        profiler.writeTrace(args.profile)
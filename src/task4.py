@@ -1,10 +1,14 @@
+import os
 import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 import numpy as np
 import rasterio
 from rasterio.fill import fillnodata
-import geopandas as gpd
-from rasterio.mask import mask
-from rasterio.mask import mask as rio_mask
+from rasterio.windows import Window
+from boundaryMask import getBoundaryMask
+from overviews import buildOverviews
+import profiler
 
 
 def get_cmd_args():
@@ -20,6 +24,9 @@ def get_cmd_args():
             5. max_search_distance (int): The maximum distance to search for valid values for interpolation.
             6. smoothing_iterations (int): The number of iterations for smoothing after filling no-data values.
             7. boundary_shapefile (str): Path to the shapefile used for clipping the output raster.
+            8. block_size (int): Side in pixels of the blocks filled at a time.
+            9. workers (int): Number of threads filling blocks.
+            10. profile (str): Write per-stage and per-block timings to this Chrome trace file.
     """
     parser = argparse.ArgumentParser(description="Fill no-data values in a DEM and clip to a boundary shapefile.")
     parser.add_argument("--input", type=str, default='src/outputs/t3_outputs/mosaic_2009.tif', help="Input GeoTIFF file with no-data values")
@@ -29,10 +36,67 @@ def get_cmd_args():
     parser.add_argument("--max_search_distance", type=int, default=110, help="Maximum number of cells to search for valid values to interpolate")
     parser.add_argument("--smoothing_iterations", type=int, default=0, help="Number of smoothing iterations to run after filling no-data values")
     parser.add_argument("--boundary_shapefile", type=str, default = 'additional/boundary.shp', help="Path to the boundary shapefile for clipping the output")
+    parser.add_argument("--block_size", type=int, default=1024, help="Side in pixels of the blocks filled at a time")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="Number of threads filling blocks")
+    parser.add_argument("--profile", type=str, default=None, help="Write a per-block timing trace (Chrome trace JSON) to this file")
     return parser.parse_args()
 
 
-def clip_and_fill(input_file, boundary_shapefile, output_file, nodata_value, max_search_distance, smoothing_iterations):
+def block_windows(width, height, block_size):
+    """
+    Split a raster of the given size into square windows of block_size pixels, row by row.
+    """
+    for row in range(0, height, block_size):
+        for col in range(0, width, block_size):
+            yield Window(col, row, min(block_size, width - col), min(block_size, height - row))
+
+
+def fill_block(src, read_lock, boundary, block, crop, halo, nodata_value, out_nodata, max_search_distance, smoothing_iterations):
+    """
+    Fill and clip one output block. Runs in a worker thread.
+
+    Parameters:
+        1. src (rasterio.DatasetReader): The open input raster.
+        2. read_lock (threading.Lock): Held while reading from src, which is not thread safe.
+        3. boundary (boundaryMask): The boundary rasterised on the input grid.
+        4. block (Window): The block, in output pixel coordinates.
+        5. crop (Window): Where the output sits in the input raster.
+        6. halo (int): Pixels read around the block so gaps at its edge are filled as if the raster were whole.
+        7. nodata_value (float): The no-data value in the input file.
+        8. out_nodata (float): The no-data value written outside the boundary and in gaps left unfilled.
+        9. max_search_distance (int): The maximum search distance in pixels for interpolation.
+        10. smoothing_iterations (int): The number of smoothing iterations applied to the filled values.
+
+    Returns the block and its filled, clipped values.
+    """
+    # block plus its halo in input pixels, cut to the raster's extent
+    col0 = max(int(crop.col_off + block.col_off) - halo, 0)
+    row0 = max(int(crop.row_off + block.row_off) - halo, 0)
+    col1 = min(int(crop.col_off + block.col_off + block.width) + halo, src.width)
+    row1 = min(int(crop.row_off + block.row_off + block.height) + halo, src.height)
+    read_window = Window(col0, row0, col1 - col0, row1 - row0)
+    with profiler.stage("fillBlock", row=int(block.row_off), col=int(block.col_off)):
+        with read_lock:
+            data = src.read(1, window=read_window)
+        profiler.record(bytesRead=data.nbytes)
+
+        # fill the gaps from the valid pixels around them
+        valid = data != nodata_value
+        if np.any(valid) and not np.all(valid):
+            data = fillnodata(data, mask=valid.astype(np.uint8), max_search_distance=max_search_distance,
+                              smoothing_iterations=smoothing_iterations)
+
+    # cut the halo away again, mark gaps too wide to fill and clip to the boundary
+    r = int(crop.row_off + block.row_off) - row0
+    c = int(crop.col_off + block.col_off) - col0
+    out = data[r:r + int(block.height), c:c + int(block.width)]
+    out = np.where(out == nodata_value, out_nodata, out).astype(data.dtype)
+    out = boundary.apply(out, out_nodata, rowOff=int(block.row_off), colOff=int(block.col_off))
+    return block, out
+
+
+def clip_and_fill(input_file, boundary_shapefile, output_file, nodata_value, max_search_distance, smoothing_iterations,
+                  block_size=1024, workers=1, new_nodata_value=None):
     """
         Clips the input raster to a given boundary and fills no-data values within the clipped region.
 
@@ -40,43 +104,64 @@ def clip_and_fill(input_file, boundary_shapefile, output_file, nodata_value, max
             1. input_file (str): Path to the input GeoTIFF file.
             2. boundary_shapefile (str): Path to the boundary shapefile for clipping the raster.
             3. output_file (str): Path where the processed GeoTIFF will be saved.
-            3. nodata_value (float): The no-data value in the input file to identify areas to fill.
-            4. max_search_distance (int): The maximum search distance in pixels for interpolation.
-            5. smoothing_iterations (int): The number of iterations applied to smooth the filled raster.
-
-        The function reads the input raster, applies a mask based on the boundary shapefile to clip it,
-        then fills the no-data values within this clipped region, optionally smoothing the result before saving.
+            4. nodata_value (float): The no-data value in the input file to identify areas to fill.
+            5. max_search_distance (int): The maximum search distance in pixels for interpolation.
+            6. smoothing_iterations (int): The number of iterations applied to smooth the filled raster.
+            7. block_size (int): Side in pixels of the blocks filled at a time.
+            8. workers (int): Number of threads filling blocks.
+            9. new_nodata_value (float): The no-data value of the output. Defaults to the input's no-data value.
+
+        The raster is cropped to the boundary's extent and processed block by block. Each block is read with a halo
+        of max_search_distance (plus one pixel per smoothing iteration) so its gaps are filled exactly as a whole
+        raster fill would, then pixels outside the boundary are set to no-data and the block is written out.
+        The boundary is rasterised once per input grid and cached next to the shapefile as a packed bitmask,
+        so repeat runs on the same grid do not read the shapefile at all. Only a few blocks are held at once, so
+        memory stays bounded for campaign-wide mosaics, and the blocks are filled on a thread pool as GDAL
+        releases the GIL while interpolating. Overviews are added for quick previews.
     """
     with rasterio.open(input_file) as src:
-        meta = src.meta.copy()  # Copy the metadata while the file is open
-        data = src.read(1)
-
-    # Continue processing outside the 'with' block
-    boundary = gpd.read_file(boundary_shapefile)
-    boundary = boundary.to_crs(meta['crs'])
-    shapes = [feature.geometry for feature in boundary.itertuples()]
-
-    
-    with rasterio.open(input_file) as src:
-        out_image, out_transform = rio_mask(src, shapes, crop=True, nodata=meta['nodata'])
-        meta.update({"height": out_image.shape[1], "width": out_image.shape[2], "transform": out_transform})
-
-        valid_data_mask = (out_image != nodata_value)
-
-    # Assuming out_image might have an incorrect shape, adjust it.
-        if out_image.shape[0] == 1:
-            out_image = np.squeeze(out_image, axis=0)
-
-
-        # Then write the adjusted image to the file.
-        with rasterio.open(output_file, 'w', **meta) as dst:
-            dst.write(out_image, 1)
-
-
-
-
+        boundary = getBoundaryMask(boundary_shapefile, src.transform, src.shape, src.crs)
+
+        # crop to the boundary, as rasterio.mask would
+        crop = boundary.cropWindow()
+        if crop.width <= 0 or crop.height <= 0:
+            raise ValueError("Boundary " + boundary_shapefile + " does not intersect the input raster " + input_file)
+        if new_nodata_value is not None:
+            out_nodata = new_nodata_value
+        else:
+            out_nodata = src.nodata if src.nodata is not None else nodata_value
+        meta = src.meta.copy()
+        meta.update({"height": int(crop.height), "width": int(crop.width), "transform": src.window_transform(crop),
+                     "nodata": out_nodata, "tiled": True, "blockxsize": 256, "blockysize": 256})
+        halo = max_search_distance + smoothing_iterations
+
+        # keep the mask for the output grid too, for task5 to reuse
+        boundary.cropped(boundary_shapefile, meta['transform'], src.crs)
+
+        read_lock = threading.Lock()
+        blocks = block_windows(int(crop.width), int(crop.height), block_size)
+        with rasterio.open(output_file, 'w', **meta) as dst, ThreadPoolExecutor(max_workers=max(workers, 1)) as pool:
+            # keep a couple of blocks per thread in flight, writing each as it finishes
+            pending = set()
+            for block in blocks:
+                pending.add(pool.submit(fill_block, src, read_lock, boundary, block, crop, halo, nodata_value, out_nodata,
+                                        max_search_distance, smoothing_iterations))
+                if len(pending) >= 2 * max(workers, 1):
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        window, out = future.result()
+                        dst.write(out, 1, window=window)
+            for future in pending:
+                window, out = future.result()
+                dst.write(out, 1, window=window)
+            buildOverviews(dst)
 
 
 if __name__ == "__main__":
     args = get_cmd_args()
-    clip_and_fill(args.input, args.boundary_shapefile, args.output, args.nodata_value, args.max_search_distance, args.smoothing_iterations)
\ No newline at end of file
+    if args.profile:
+        profiler.enable(args.profile)
+    clip_and_fill(args.input, args.boundary_shapefile, args.output, args.nodata_value, args.max_search_distance, args.smoothing_iterations,
+                  block_size=args.block_size, workers=args.workers, new_nodata_value=args.new_nodata_value)
+    if args.profile:
+        profiler.writeTrace(args.profile)
\ No newline at end of file
@@ -1,58 +1,271 @@
+import os
+import argparse
 import rasterio
+from rasterio.vrt import WarpedVRT
+from rasterio.enums import Resampling
+from rasterio.windows import Window
+from rasterio.features import rasterize
 import numpy as np
 import matplotlib.pyplot as plt
+from boundaryMask import getBoundaryMask
+from overviews import buildOverviews, previewShape
+import profiler
+
+def zone_totals(labels, n_zones, valid, inside, change, pixel_area):
+    """
+    Add up one window's elevation change per zone label with bincount, for every zone at once.
+
+    - labels: Zone label of each pixel, 0 for none and 1 to n_zones for the zones.
+    - n_zones: Number of zones.
+    - valid: Pixels with data in both years, inside the boundary.
+    - inside: Pixels inside the boundary, every pixel if there is none.
+    - change: Elevation change of each pixel.
+    - pixel_area: Area of one pixel.
+    - Return arrays, indexed by label, of the volume change, the valid pixel count and the total pixel count.
+    """
+    volume = np.bincount(labels[valid], weights=change[valid], minlength=n_zones + 1) * pixel_area
+    valid_count = np.bincount(labels[valid], minlength=n_zones + 1)
+    total_count = np.bincount(labels[inside], minlength=n_zones + 1)
+    return volume, valid_count, total_count
+
+def zone_table(names, volume, valid_count, total_count, pixel_area):
+    """
+    Turn accumulated zone totals into one dictionary of statistics per zone.
+
+    Mean change is the mean elevation change (negative for thinning) over pixels with data in both years, and
+    coverage is the fraction of the zone's pixels inside the boundary that have data in both years.
+    """
+    table = []
+    for label, name in enumerate(names, start=1):
+        table.append({"zone": name, "volume_change": volume[label], "valid_area": valid_count[label] * pixel_area,
+                      "mean_change": volume[label] / (valid_count[label] * pixel_area) if valid_count[label] > 0 else np.nan,
+                      "coverage": valid_count[label] / total_count[label] if total_count[label] > 0 else 0.0})
+    return table
 
 class DEMAnalysis:
-    def __init__(self, dem_file_2009, dem_file_2015):
-        self.dem_2009 = self.read_geotiff(dem_file_2009)
-        self.dem_2015 = self.read_geotiff(dem_file_2015)
+    def __init__(self, dem_file_2009, dem_file_2015, boundary_shapefile=None, block_size=1024):
+        self.dem_file_2009 = dem_file_2009
+        self.dem_file_2015 = dem_file_2015
+        self.block_size = block_size
+        self.profile = self.read_profile(dem_file_2009)
+        self.stats = None
+        self.zone_labels = None
+        self.zone_names = []
+        self.band_edges = None
+        self.zone_stats = None
+        self.band_stats = None
+        self.boundary = None
+        if boundary_shapefile is not None:
+            # the mask cached by task4 for this grid, made here if needed
+            self.boundary = getBoundaryMask(boundary_shapefile, self.profile['transform'], (self.profile['height'], self.profile['width']), self.profile['crs'])
 
-    def read_geotiff(self, file_path):
+    def read_profile(self, file_path):
         """
-        Read a GeoTIFF file and return its data and profile.
+        Read the profile of a GeoTIFF file, without reading its data.
 
         - file_path: Path to the GeoTIFF file to be read.
-        - Return a tuple which contains raster data and metadata.
+        - Return the raster's metadata.
         """
         with rasterio.open(file_path) as src:
-            return src.read(1), src.profile
+            return src.profile
+
+    def set_zones(self, zone_file, name_field=None):
+        """
+        Rasterise a layer of zone polygons (for example drainage basins) once into a label grid on the 2009 DEM grid.
+
+        Zone statistics are then added up in the differencing pass for every zone at once, so adding zones costs
+        almost nothing. Where polygons overlap, the later one wins.
+
+        - zone_file: Path to a vector file of zone polygons.
+        - name_field: Attribute used to name the zones. Zones are numbered from 1 if not given.
+        """
+        import geopandas as gpd  # only needed for zonal statistics
+        zones = gpd.read_file(zone_file).to_crs(self.profile['crs'])
+        self.zone_names = list(zones[name_field]) if name_field is not None else list(range(1, len(zones) + 1))
+        dtype = np.uint16 if len(zones) < np.iinfo(np.uint16).max else np.int32
+        self.zone_labels = rasterize(((geometry, label) for label, geometry in enumerate(zones.geometry, start=1)),
+                                     out_shape=(self.profile['height'], self.profile['width']),
+                                     transform=self.profile['transform'], fill=0, dtype=dtype)
+        self.stats = None
+
+    def set_elevation_bands(self, band_edges):
+        """
+        Group the change statistics into bands of 2009 elevation as well.
+
+        - band_edges: Increasing band edges in metres. Band i holds elevations from band_edges[i] up to band_edges[i + 1].
+        """
+        self.band_edges = np.asarray(band_edges, dtype=np.float64)
+        self.stats = None
+
+    def same_grid(self, src):
+        """
+        Check whether a raster is on the same grid as the 2009 DEM.
+
+        - src: An open rasterio dataset.
+        - Return True if the CRS, transform and size all match.
+        """
+        return (src.crs == self.profile['crs'] and src.transform.almost_equals(self.profile['transform'])
+                and src.width == self.profile['width'] and src.height == self.profile['height'])
+
+    def difference(self, output_file=None):
+        """
+        Difference the two DEMs (2015 - 2009) in one pass, a window at a time.
+
+        The 2015 DEM is resampled onto the 2009 grid on the fly if the two grids differ. Pixels that are no-data
+        in either DEM, or outside the boundary if one was given, are left out of the totals and written as no-data.
+
+        If zones or elevation bands have been set, their statistics are added up in the same pass and kept in
+        self.zone_stats and self.band_stats.
+
+        - output_file: Path of a GeoTIFF to write the elevation change to, window by window, or None.
+        - Return a dictionary with the volume change (m^3), the valid area (m^2) and the valid and total pixel counts.
+        """
+        transform = self.profile['transform']
+        pixel_area = abs(transform.a * transform.e - transform.b * transform.d)
+        out_nodata = self.profile['nodata'] if self.profile['nodata'] is not None else -999.0
+        volume = 0.0
+        valid_pixels = 0
+        n_zones = len(self.zone_names)
+        zone_sums = [np.zeros(n_zones + 1), np.zeros(n_zones + 1, dtype=np.int64), np.zeros(n_zones + 1, dtype=np.int64)]
+        n_bands = len(self.band_edges) - 1 if self.band_edges is not None else 0
+        band_sums = [np.zeros(n_bands + 1), np.zeros(n_bands + 1, dtype=np.int64), np.zeros(n_bands + 1, dtype=np.int64)]
+
+        with rasterio.open(self.dem_file_2009) as src_2009, rasterio.open(self.dem_file_2015) as src_2015:
+            nodata_2009 = src_2009.nodata
+            nodata_2015 = src_2015.nodata
+            dem_2015 = src_2015
+            if not self.same_grid(src_2015):
+                print("DEM grids differ, resampling the 2015 DEM onto the 2009 grid")
+                dem_2015 = WarpedVRT(src_2015, crs=self.profile['crs'], transform=transform, width=self.profile['width'],
+                                     height=self.profile['height'], resampling=Resampling.bilinear, nodata=nodata_2015)
+
+            dst = None
+            if output_file is not None:
+                profile = self.profile.copy()
+                profile.update({"dtype": "float32", "nodata": out_nodata, "tiled": True, "blockxsize": 256, "blockysize": 256})
+                dst = rasterio.open(output_file, 'w', **profile)
+
+            try:
+                for row in range(0, self.profile['height'], self.block_size):
+                    for col in range(0, self.profile['width'], self.block_size):
+                        window = Window(col, row, min(self.block_size, self.profile['width'] - col), min(self.block_size, self.profile['height'] - row))
+                        a = src_2009.read(1, window=window)
+                        b = dem_2015.read(1, window=window)
+                        profiler.record(bytesRead=a.nbytes + b.nbytes)
+                        a = a.astype(np.float64)
+                        b = b.astype(np.float64)
+
+                        # pixels with data in both years, inside the boundary
+                        valid = np.isfinite(a) & np.isfinite(b)
+                        if nodata_2009 is not None:
+                            valid &= a != nodata_2009
+                        if nodata_2015 is not None:
+                            valid &= b != nodata_2015
+                        if self.boundary is not None:
+                            inside = self.boundary.block(row, col, int(window.height), int(window.width))
+                        else:
+                            inside = np.ones(valid.shape, dtype=bool)
+                        valid &= inside
+
+                        change = np.where(valid, b - a, out_nodata)
+                        volume += np.sum(change[valid]) * pixel_area
+                        valid_pixels += int(np.count_nonzero(valid))
+
+                        # per zone and per band totals, all zones in one bincount
+                        if self.zone_labels is not None:
+                            labels = self.zone_labels[row:row + int(window.height), col:col + int(window.width)]
+                            for total, part in zip(zone_sums, zone_totals(labels, n_zones, valid, inside, change, pixel_area)):
+                                total += part
+                        if n_bands > 0:
+                            has_2009 = np.isfinite(a) if nodata_2009 is None else np.isfinite(a) & (a != nodata_2009)
+                            labels = np.digitize(a, self.band_edges)
+                            labels[(labels > n_bands) | ~has_2009] = 0  # outside every band
+                            for total, part in zip(band_sums, zone_totals(labels, n_bands, valid, inside, change, pixel_area)):
+                                total += part
+                        if dst is not None:
+                            dst.write(change.astype(np.float32), 1, window=window)
+                            profiler.record(bytesWritten=change.size * 4)
+                if dst is not None:
+                    buildOverviews(dst)  # decimated levels for previews
+            finally:
+                if dst is not None:
+                    dst.close()
+                if dem_2015 is not src_2015:
+                    dem_2015.close()
+
+        self.stats = {"volume_change": volume, "valid_area": valid_pixels * pixel_area, "valid_pixels": valid_pixels,
+                      "total_pixels": self.profile['width'] * self.profile['height']}
+        if self.zone_labels is not None:
+            self.zone_stats = zone_table(self.zone_names, *zone_sums, pixel_area)
+        if n_bands > 0:
+            band_names = list(zip(self.band_edges[:-1].tolist(), self.band_edges[1:].tolist()))
+            self.band_stats = zone_table(band_names, *band_sums, pixel_area)
+        return self.stats
 
     def calculate_volume_change(self):
         """
         Calculate the total volume change between the two DEMs.
-        Returns the total volume change computed by integrating the elevation differences over the area.
+        Returns the total volume change computed by integrating the elevation differences over the area
+        with data in both years, only inside the boundary if one was given.
+        """
+        if self.stats is None:
+            self.difference()
+        return self.stats['volume_change']
+
+    def zonal_stats(self):
+        """
+        Volume change, mean change, valid area and coverage fraction for every zone and elevation band.
+        Returns (zone_stats, band_stats), each a list of dictionaries or None if not set.
         """
-        elevation_change = self.dem_2015[0] - self.dem_2009[0]
-        volume_change = np.sum(elevation_change) * self.dem_2009[1]['transform'][0] * self.dem_2009[1]['transform'][4]
-        return volume_change
+        if self.stats is None:
+            self.difference()
+        return self.zone_stats, self.band_stats
 
-    def create_change_map(self, output_file, show_map=True):
+    def create_change_map(self, output_file, show_map=True, max_display=2048):
         """
         Create a GeoTIFF map that visualises the elevation change between two DEMs and optionally display it.
+        The volume change and areas are worked out in the same pass, so calculate_volume_change does not repeat it.
+        The map is shown from a reduced read of at most max_display pixels a side.
         """
-        elevation_change = self.dem_2015[0] - self.dem_2009[0]
-        with rasterio.open(output_file, 'w', **self.dem_2009[1]) as dst:
-            dst.write(elevation_change, 1)
+        self.difference(output_file)
 
         if show_map:
-            plt.figure(figsize=(10, 10))
-            plt.imshow(elevation_change, cmap='coolwarm', vmin=np.nanmin(elevation_change), vmax=np.nanmax(elevation_change))
-            plt.colorbar(label='Elevation Change (m)')
-            plt.title('Elevation Change 2009 - 2015')
-            plt.show()
+            self.show_change_map(output_file, max_display=max_display)
 
-# Define output directory
-output_directory = "src/outputs/t5_outputs/"
-output_file = output_directory + "elevation_change.tif"
+    def show_change_map(self, output_file, max_display=2048):
+        """
+        Display an elevation change GeoTIFF, read at most max_display pixels a side.
+        """
+        with rasterio.open(output_file) as src:
+            elevation_change = src.read(1, out_shape=previewShape(src.width, src.height, max_display), masked=True)
+        plt.figure(figsize=(10, 10))
+        plt.imshow(elevation_change, cmap='coolwarm', vmin=np.nanmin(elevation_change), vmax=np.nanmax(elevation_change))
+        plt.colorbar(label='Elevation Change (m)')
+        plt.title('Elevation Change 2009 - 2015')
+        plt.show()
 
-# Ensure output directory exists
-import os
-if not os.path.exists(output_directory):
-    os.makedirs(output_directory)
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Difference the filled 2009 and 2015 DEMs.")
+    parser.add_argument("--profile", type=str, default=None, help="Write a per-stage timing trace (Chrome trace JSON) to this file")
+    args = parser.parse_args()
+    if args.profile:
+        profiler.enable(args.profile)
+
+    # Define output directory
+    output_directory = "src/outputs/t5_outputs/"
+    output_file = output_directory + "elevation_change.tif"
 
-# Execute analysis with updated paths
-dem_analysis = DEMAnalysis("src/outputs/t4_outputs/filled_2009_DEM.tif", "src/outputs/t4_outputs/filled_2015_DEM.tif")
-volume_change = dem_analysis.calculate_volume_change()
-print(f"Total Volume Change: {volume_change}")
-dem_analysis.create_change_map(output_file)
+    # Ensure output directory exists
+    if not os.path.exists(output_directory):
+        os.makedirs(output_directory)
 
+    # Execute analysis with updated paths
+    dem_analysis = DEMAnalysis("src/outputs/t4_outputs/filled_2009_DEM.tif", "src/outputs/t4_outputs/filled_2015_DEM.tif", boundary_shapefile="additional/boundary.shp")
+    with profiler.stage("difference"):
+        dem_analysis.create_change_map(output_file, show_map=False)  # one pass gives the map and the totals
+    volume_change = dem_analysis.calculate_volume_change()
+    print(f"Total Volume Change: {volume_change}")
+    print(f"Area with data in both years: {dem_analysis.stats['valid_area']} m^2 ({dem_analysis.stats['valid_pixels']} of {dem_analysis.stats['total_pixels']} pixels)")
+    if args.profile:
+        profiler.writeTrace(args.profile)
+    dem_analysis.show_change_map(output_file)
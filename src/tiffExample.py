@@ -10,51 +10,116 @@ from pyproj import Proj, transform # package for reprojecting data
 from osgeo import gdal             # pacage for handling geotiff data
 from osgeo import osr              # pacage for handling projection information
 import numpy as np
+import os
+import profiler
+from overviews import buildOverviews
 
 
 
 #####################################
 
-def writeTiff(data,x,y,res,filename="lvis_image.tif",epsg=4326):
+def gridPoints(data,x,y,res,minX,maxY,nX,nY,stat="mean",nodata=-999.0):
   '''
-  Make a geotiff from an array of points
+  Aggregate points in to an nY by nX grid
+  with top left corner minX,maxY in a single
+  vectorised pass. stat is one of mean,
+  median, min, max, count or std. Points
+  flagged as nodata are left out.
+  Returns the image and the point count
   '''
-
-  # determine bounds
-  minX=np.min(x)
-  maxX=np.max(x)
-  minY=np.min(y)
-  maxY=np.max(y)
-
-  # determine image size
-  nX=int((maxX-minX)/res+1)
-  nY=int((maxY-minY)/res+1)
-
-  # pack in to array
-  imageArr=np.full((nY,nX),-999.0)        # make an array of missing data flags
+  data=np.asarray(data,dtype=np.float64)
 
   # calculate the raster pixel index in x and y
-  xInds=np.array(np.floor((x-np.min(x))/res),dtype=int)   # need to force to int type
-  yInds=np.array(np.floor((np.max(y)-y)/res),dtype=int)
+  xInds=np.array(np.floor((x-minX)/res),dtype=int)   # need to force to int type
+  yInds=np.array(np.floor((maxY-y)/res),dtype=int)
   # floor rounds down. y is from top to bottom
 
-  # this is a simple pack which will assign a single footprint to each pixel
-  imageArr[yInds,xInds]=data
+  # drop missing data and anything off the grid
+  keep=(data!=nodata)&np.isfinite(data)&(xInds>=0)&(xInds<nX)&(yInds>=0)&(yInds<nY)
+  flat=yInds[keep]*nX+xInds[keep]     # one number per pixel
+  vals=data[keep]
+
+  # number of footprints per pixel
+  count=np.bincount(flat,minlength=nX*nY)
+  filled=count>0
+  image=np.full(nX*nY,nodata)         # make an array of missing data flags
+
+  if(stat=="count"):
+    image[filled]=count[filled]
+  elif(stat in ("mean","std")):
+    mean=np.bincount(flat,weights=vals,minlength=nX*nY)[filled]/count[filled]
+    if(stat=="mean"):
+      image[filled]=mean
+    else:
+      # deviations from the pixel mean, to avoid cancellation
+      pixMean=np.zeros(nX*nY)
+      pixMean[filled]=mean
+      dev2=np.bincount(flat,weights=(vals-pixMean[flat])**2,minlength=nX*nY)
+      image[filled]=np.sqrt(dev2[filled]/count[filled])
+  elif(stat in ("median","min","max")):
+    # sort by pixel then value, so each pixel is a sorted run
+    order=np.lexsort((vals,flat))
+    sortVals=vals[order]
+    pix=np.flatnonzero(filled)
+    starts=np.concatenate(([0],np.cumsum(count[pix])[:-1])).astype(int)
+    nPix=count[pix]
+    if(stat=="min"):
+      image[pix]=sortVals[starts]
+    elif(stat=="max"):
+      image[pix]=sortVals[starts+nPix-1]
+    else:
+      image[pix]=(sortVals[starts+(nPix-1)//2]+sortVals[starts+nPix//2])/2.0
+  else:
+    raise ValueError("Unknown pixel statistic "+str(stat))
+
+  return(image.reshape((nY,nX)),count.reshape((nY,nX)))
 
-  # set geolocation information (note geotiffs count down from top edge in Y)
-  geotransform = (minX, res, 0, maxY, 0, -res)
 
-  # load data in to geotiff object
-  dst_ds = gdal.GetDriverByName('GTiff').Create(filename, nX, nY, 1, gdal.GDT_Float32)
+#####################################
+
+def writeTiff(data,x,y,res,filename="lvis_image.tif",epsg=4326,stat="mean",nodata=-999.0,countBand=False):
+  '''
+  Make a geotiff from an array of points.
+  Footprints sharing a pixel are combined
+  with stat (mean, median, min, max, count
+  or std) and nodata footprints are skipped.
+  countBand=True adds the number of
+  footprints per pixel as a second band
+  '''
 
-  dst_ds.SetGeoTransform(geotransform)    # specify coords
-  srs = osr.SpatialReference()            # establish encoding
-  srs.ImportFromEPSG(epsg)                # WGS84 lat/long
-  dst_ds.SetProjection(srs.ExportToWkt()) # export coords to file
-  dst_ds.GetRasterBand(1).WriteArray(imageArr)  # write image to the raster
-  dst_ds.GetRasterBand(1).SetNoDataValue(-999)  # set no data value
-  dst_ds.FlushCache()                     # write to disk
-  dst_ds = None
+  with profiler.stage("writeTiff",shots=len(data)):
+    # determine bounds
+    minX=np.min(x)
+    maxX=np.max(x)
+    minY=np.min(y)
+    maxY=np.max(y)
+
+    # determine image size
+    nX=int((maxX-minX)/res+1)
+    nY=int((maxY-minY)/res+1)
+
+    # pack in to array, combining footprints in the same pixel
+    imageArr,countArr=gridPoints(data,x,y,res,minX,maxY,nX,nY,stat=stat,nodata=nodata)
+
+    # set geolocation information (note geotiffs count down from top edge in Y)
+    geotransform = (minX, res, 0, maxY, 0, -res)
+
+    # load data in to geotiff object
+    nBands=2 if(countBand) else 1
+    dst_ds = gdal.GetDriverByName('GTiff').Create(filename, nX, nY, nBands, gdal.GDT_Float32)
+
+    dst_ds.SetGeoTransform(geotransform)    # specify coords
+    srs = osr.SpatialReference()            # establish encoding
+    srs.ImportFromEPSG(epsg)                # WGS84 lat/long
+    dst_ds.SetProjection(srs.ExportToWkt()) # export coords to file
+    dst_ds.GetRasterBand(1).WriteArray(imageArr)  # write image to the raster
+    dst_ds.GetRasterBand(1).SetNoDataValue(nodata)  # set no data value
+    if(countBand):
+      dst_ds.GetRasterBand(2).WriteArray(countArr)  # footprints per pixel
+    buildOverviews(dst_ds)                  # decimated levels for previews
+    dst_ds.FlushCache()                     # write to disk
+    dst_ds = None
+    profiler.record(bytesWritten=os.path.getsize(filename))
 
   print("Image written to",filename)
   return
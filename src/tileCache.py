@@ -0,0 +1,163 @@
+
+'''
+A manifest of finished outputs, keyed
+by everything that went in to them, so
+re-runs only rebuild what has changed
+'''
+
+###################################
+import os
+import json
+import hashlib
+from lvisIndex import fileFingerprint
+
+
+###################################
+
+def makeKey(**params):
+  '''
+  Content hash of a set of parameters.
+  Values must be JSON serialisable
+  '''
+  text=json.dumps(params,sort_keys=True,default=str)
+  return(hashlib.sha1(text.encode()).hexdigest())
+
+
+###################################
+
+def inputFingerprint(filename):
+  '''
+  Identify an input file by path,
+  size and modification time
+  '''
+  size,mtime=fileFingerprint(filename)
+  return([os.path.abspath(filename),size,mtime])
+
+
+###################################
+
+class tileCache(object):
+  '''
+  Append-only manifest of outputs
+  and the keys they were made with
+  '''
+
+  def __init__(self,folder,manifestName="tile_manifest.jsonl",enabled=True):
+    '''
+    Class initialiser. Reads the manifest
+    in folder if there is one.
+    enabled=False forces every output
+    to be rebuilt but still records them
+    '''
+    self.manifest=os.path.join(folder,manifestName)
+    self.enabled=enabled
+    self.entries={}
+    self.parts={}
+    if(os.path.exists(self.manifest)):
+      with open(self.manifest) as f:
+        for line in f:
+          try:
+            entry=json.loads(line)
+          except ValueError:   # partly written line from a crash
+            continue
+          if('part' in entry):
+            self.parts.setdefault(entry['output'],set()).add(entry['part'])
+          else:
+            self.entries[entry['output']]=entry   # later lines win
+            if(entry.get('partial')):
+              self.parts[entry['output']]=set()   # a fresh build
+
+
+  ###########################################
+
+  def lookup(self,key,outName):
+    '''
+    True if outName exists and was
+    last written with this key
+    '''
+    if(not self.enabled):
+      return(False)
+    entry=self.entries.get(os.path.abspath(outName))
+    if((entry is None)or entry.get('partial')or(entry['key']!=key)or(not os.path.exists(outName))):
+      return(False)
+    return(list(fileFingerprint(outName))==entry['fingerprint'])
+
+
+  ###########################################
+
+  def store(self,key,outName):
+    '''
+    Record that outName was written
+    with this key. Flushed straight
+    away so a crash loses nothing
+    '''
+    entry={'output':os.path.abspath(outName),'key':key,'fingerprint':list(fileFingerprint(outName))}
+    self.entries[entry['output']]=entry
+    self.append(entry)
+
+
+  ###########################################
+
+  def begin(self,key,outName):
+    '''
+    Start building outName piece by piece.
+    Returns True if an unfinished build
+    with the same key can be carried on,
+    otherwise records a fresh build
+    '''
+    name=os.path.abspath(outName)
+    entry=self.entries.get(name)
+    if(self.enabled and(entry is not None)and entry.get('partial')and(entry['key']==key)and os.path.exists(outName)):
+      return(True)
+    self.restart(key,outName)
+    return(False)
+
+
+  ###########################################
+
+  def restart(self,key,outName):
+    '''
+    Record a fresh build of outName,
+    forgetting any pieces already done
+    '''
+    name=os.path.abspath(outName)
+    entry={'output':name,'key':key,'partial':True}
+    self.entries[name]=entry
+    self.parts[name]=set()
+    self.append(entry)
+
+
+  ###########################################
+
+  def partDone(self,outName,partKey):
+    '''
+    True if this piece is already in
+    the build of outName
+    '''
+    return(partKey in self.parts.get(os.path.abspath(outName),()))
+
+
+  ###########################################
+
+  def storePart(self,outName,partKey):
+    '''
+    Record that a piece has been written
+    to outName. outName must be flushed
+    to disk first
+    '''
+    name=os.path.abspath(outName)
+    self.parts.setdefault(name,set()).add(partKey)
+    self.append({'output':name,'part':partKey})
+
+
+  ###########################################
+
+  def append(self,entry):
+    '''
+    Add a line to the manifest
+    '''
+    with open(self.manifest,'a') as f:
+      f.write(json.dumps(entry)+"\n")
+
+
+###########################################
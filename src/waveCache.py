@@ -0,0 +1,185 @@
+
+'''
+An uncompressed, memory-mapped copy of
+an LVIS file's waveforms, so repeated
+runs read them straight from the page
+cache instead of decompressing HDF5
+'''
+
+###################################
+import os
+import json
+import numpy as np
+import h5py
+from lvisIndex import fileFingerprint
+
+
+###################################
+
+# marks the start of a cache file
+MAGIC=b"LVISWAVE"
+
+# bytes reserved for the header, arrays start after it
+HEADER_SIZE=4096
+
+# waves copied per block when exporting
+EXPORT_BLOCK=8192
+
+# caches already open in this process, by filename
+_waveCaches={}
+
+
+###################################
+
+def getWaveCache(filename,cacheName=None):
+  '''
+  Return the waveform cache for a file,
+  exporting it the first time and reusing
+  one already open in this process if the
+  file is unchanged. Returns None if the
+  cache can not be written, in which case
+  the HDF5 file should be read as normal
+  '''
+  cache=_waveCaches.get(filename)
+  if((cache is None)or(cache.fingerprint!=fileFingerprint(filename))):
+    try:
+      cache=waveCache(filename,cacheName=cacheName)
+    except OSError:    # read-only data drive
+      return(None)
+    _waveCaches[filename]=cache
+  return(cache)
+
+
+###################################
+
+def contiguousRows(arr,useInd):
+  '''
+  Rows useInd (sorted) of arr. A run of
+  consecutive rows is returned as a view,
+  anything else is gathered in to a copy
+  '''
+  useInd=np.asarray(useInd)
+  if((useInd.shape[0]>0)and(useInd[-1]-useInd[0]+1==useInd.shape[0])):
+    return(arr[useInd[0]:useInd[-1]+1])
+  return(arr[useInd])
+
+
+###################################
+
+class waveCache(object):
+  '''
+  Waveforms of one LVIS file with the
+  top and bottom elevation of each,
+  held in a single flat file:
+  a JSON header of HEADER_SIZE bytes
+  (nShots, nBins, dtype, offsets and the
+  HDF5 file fingerprint) followed by
+  Z0, ZN and the (nShots,nBins) waves
+  '''
+
+  def __init__(self,filename,cacheName=None):
+    '''
+    Class initialiser. Opens the cache
+    file if it matches the HDF5 file,
+    otherwise exports it first
+    '''
+    self.filename=filename
+    self.cacheName=cacheName if(cacheName is not None) else filename+".wave"
+    self.fingerprint=fileFingerprint(filename)
+    if(not self.openCache()):
+      self.export()
+      if(not self.openCache()):
+        raise OSError("Could not open waveform cache "+self.cacheName)
+
+
+  ###########################################
+
+  def readHeader(self):
+    '''
+    Read the header of the cache file,
+    or None if it is missing or stale
+    '''
+    if(not os.path.exists(self.cacheName)):
+      return(None)
+    with open(self.cacheName,'rb') as f:
+      raw=f.read(HEADER_SIZE)
+    if(not raw.startswith(MAGIC)):
+      return(None)
+    try:
+      header=json.loads(raw[len(MAGIC):].rstrip(b"\0 ").decode())
+    except ValueError:
+      return(None)
+    if(tuple(header.get('fingerprint',()))!=self.fingerprint):
+      return(None)
+    return(header)
+
+
+  ###########################################
+
+  def openCache(self):
+    '''
+    Map the arrays in the cache file as
+    read-only views. Returns False if
+    it needs exporting again
+    '''
+    header=self.readHeader()
+    if(header is None):
+      return(False)
+    self.nShots=header['nShots']
+    self.nBins=header['nBins']
+    self.dtype=np.dtype(header['dtype'])
+    if(self.nShots==0):
+      self.lZ0=np.empty(0)
+      self.lZN=np.empty(0)
+      self.waves=np.empty((0,self.nBins),dtype=self.dtype)
+      return(True)
+    self.lZ0=np.memmap(self.cacheName,dtype=np.float64,mode='r',offset=header['z0Offset'],shape=(self.nShots,))
+    self.lZN=np.memmap(self.cacheName,dtype=np.float64,mode='r',offset=header['zNOffset'],shape=(self.nShots,))
+    self.waves=np.memmap(self.cacheName,dtype=self.dtype,mode='r',offset=header['waveOffset'],shape=(self.nShots,self.nBins))
+    return(True)
+
+
+  ###########################################
+
+  def export(self):
+    '''
+    Copy the waveforms out of the HDF5 file
+    a block at a time, so RAM use is
+    bounded. Written to a temporary file
+    and moved in place once complete
+    '''
+    tempName=self.cacheName+".tmp"
+    try:
+      with h5py.File(self.filename,'r') as f:
+        dset=f['RXWAVE']
+        nShots,nBins=dset.shape
+        z0Offset=HEADER_SIZE
+        zNOffset=z0Offset+8*nShots
+        waveOffset=zNOffset+8*nShots
+        header={'fingerprint':list(self.fingerprint),'nShots':nShots,'nBins':nBins,'dtype':dset.dtype.str,
+                'z0Offset':z0Offset,'zNOffset':zNOffset,'waveOffset':waveOffset}
+        text=MAGIC+json.dumps(header).encode()
+        with open(tempName,'wb') as out:
+          out.write(text.ljust(HEADER_SIZE,b"\0"))
+          out.truncate(waveOffset+nShots*nBins*dset.dtype.itemsize)
+        if(nShots>0):
+          lZ0=np.memmap(tempName,dtype=np.float64,mode='r+',offset=z0Offset,shape=(nShots,))
+          lZN=np.memmap(tempName,dtype=np.float64,mode='r+',offset=zNOffset,shape=(nShots,))
+          waves=np.memmap(tempName,dtype=dset.dtype,mode='r+',offset=waveOffset,shape=(nShots,nBins))
+          lZ0[:]=f['Z0'][:]
+          lZN[:]=f['Z'+str(nBins-1)][:]
+          for i0 in range(0,nShots,EXPORT_BLOCK):
+            i1=min(i0+EXPORT_BLOCK,nShots)
+            dset.read_direct(waves,source_sel=np.s_[i0:i1],dest_sel=np.s_[i0:i1])
+          for arr in (lZ0,lZN,waves):
+            arr.flush()
+          del lZ0,lZN,waves
+      os.replace(tempName,self.cacheName)
+    except OSError:
+      if(os.path.exists(tempName)):
+        os.remove(tempName)
+      raise
+
+
+###########################################
+
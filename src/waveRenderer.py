@@ -0,0 +1,217 @@
+
+'''
+Batch rendering of waveform plots,
+reusing one figure rather than making
+a new pyplot figure per waveform, and
+blitting only the lines on to a frame
+drawn once per batch
+'''
+
+###################################
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from PIL import Image     # installed with matplotlib
+
+
+###################################
+
+# waveforms sent to a worker process at a time
+WORKER_BATCH=256
+
+# resolution of contact sheets
+SHEET_DPI=80
+
+
+###################################
+
+class waveRenderer(object):
+  '''
+  One Agg figure with nPanels waveform
+  axes on a fixed frame. The axes, ticks
+  and labels are drawn once and kept as
+  a background, so each plot only redraws
+  its lines and labels before the pixels
+  are written straight to PNG
+  '''
+
+  def __init__(self,nPanels=1,panelSize=(6.4,4.8),dpi=None):
+    '''
+    Class initialiser. Lays panels out
+    on a near-square grid. dpi defaults to
+    100 for single plots and SHEET_DPI for
+    contact sheets, whose encoding time
+    grows with the pixel count
+    '''
+    if(dpi is None):
+      dpi=100 if(nPanels==1) else SHEET_DPI
+    self.nPanels=nPanels
+    nCols=int(np.ceil(np.sqrt(nPanels)))
+    nRows=int(np.ceil(nPanels/nCols))
+    if(nPanels==1):
+      figSize=panelSize
+    else:   # contact sheets get smaller panels
+      figSize=(nCols*panelSize[0]/2.0,nRows*panelSize[1]/2.0)
+    self.fig=Figure(figsize=figSize,dpi=dpi)
+    self.canvas=FigureCanvasAgg(self.fig)
+    self.axes=[]
+    self.lines=[]
+    self.labels=[]
+    for i in range(nPanels):
+      ax=self.fig.add_subplot(nRows,nCols,i+1)
+      line,=ax.plot([],[],color='k',linewidth=1.0,animated=True)
+      label=ax.text(0.97,0.97,"",transform=ax.transAxes,ha='right',va='top',fontsize=8,animated=True)
+      self.axes.append(ax)
+      self.lines.append(line)
+      self.labels.append(label)
+    if(nPanels==1):
+      self.axes[0].set_xlabel("Waveform return")
+      self.axes[0].set_ylabel("Elevation (m)")
+    else:
+      self.fig.supxlabel("Waveform return")
+      self.fig.supylabel("Elevation (m)")
+    self.frame=None
+    self.background=None
+
+
+  ###########################################
+
+  def setFrame(self,frame):
+    '''
+    Fix every panel to the frame from
+    waveFrame, returns 0 to xMax and
+    elevations zMin to zMax, and redraw
+    the background if the frame changed
+    '''
+    if(self.frame==frame):
+      return
+    xMax,zMin,zMax=frame
+    for ax in self.axes:
+      ax.set_xlim(0,xMax)
+      ax.set_ylim(zMin,zMax)
+    if(self.nPanels>1):
+      self.fig.tight_layout()
+    self.canvas.draw()
+    self.background=self.canvas.copy_from_bbox(self.fig.bbox)
+    self.frame=frame
+
+
+  ###########################################
+
+  def render(self,waves,z,labels,outName):
+    '''
+    Plot up to nPanels waveforms against
+    elevation and save to outName. Each
+    panel is labelled with its shot.
+    Saved as a greyscale PNG. setFrame
+    must have been called.
+    Spare panels are left empty
+    '''
+    self.canvas.restore_region(self.background)
+    for i in range(min(len(waves),self.nPanels)):
+      self.lines[i].set_data(waves[i],z[i])
+      self.labels[i].set_text(labels[i])
+      self.axes[i].draw_artist(self.lines[i])
+      self.axes[i].draw_artist(self.labels[i])
+    # everything is drawn in black and white, so one channel holds the whole
+    # plot and encodes about three times faster than RGBA
+    pixels=np.asarray(self.canvas.buffer_rgba())[:,:,0]
+    Image.fromarray(pixels).save(outName,compress_level=1)
+
+
+###################################
+
+def outNames(outRoot,inds,perSheet):
+  '''
+  Output file for each batch of
+  perSheet waveforms. Single plots keep
+  the outRoot.<index>.png naming
+  '''
+  if(perSheet==1):
+    return([outRoot+"."+str(i)+".png" for i in inds])
+  return([outRoot+".sheet."+str(inds[s])+".png" for s in range(0,len(inds),perSheet)])
+
+
+###################################
+
+def waveFrame(waves,z,inds):
+  '''
+  Axes limits (xMax,zMin,zMax) that fit
+  the waveforms at rows inds, read a
+  worker batch at a time
+  '''
+  xMax=1.0
+  zMin=np.inf
+  zMax=-np.inf
+  for s in range(0,len(inds),WORKER_BATCH):
+    use=inds[s:s+WORKER_BATCH]
+    xMax=max(xMax,float(np.max(waves[use])))
+    zBatch=np.asarray(z[use])
+    zMin=min(zMin,float(np.min(zBatch)))
+    zMax=max(zMax,float(np.max(zBatch)))
+  if(zMin>zMax):     # no waveforms
+    return((1.0,0.0,1.0))
+  if(zMin==zMax):
+    zMin,zMax=zMin-0.5,zMax+0.5
+  return((xMax*1.05,zMin,zMax))
+
+
+###################################
+
+def renderBatch(waves,z,inds,outRoot,perSheet=1,frame=None):
+  '''
+  Render waveforms waves[j] against z[j],
+  labelled by file index inds[j], either
+  one per PNG or perSheet per contact
+  sheet, all on the same axes limits,
+  frame, fitted to this batch if not given.
+  Returns the files written
+  '''
+  waves=np.asarray(waves)
+  z=np.asarray(z)
+  if(frame is None):
+    frame=waveFrame(waves,z,list(range(len(inds))))
+  # one frame for every plot, so axes and ticks are drawn once
+  renderer=waveRenderer(nPanels=perSheet)
+  renderer.setFrame(frame)
+  names=outNames(outRoot,inds,perSheet)
+  for k,name in enumerate(names):
+    s=k*perSheet
+    e=min(s+perSheet,len(inds))
+    renderer.render(waves[s:e],z[s:e],["Shot "+str(i) for i in inds[s:e]],name)
+    print("Graph to",name)
+  return(names)
+
+
+###################################
+
+def renderWaves(waves,z,inds,outRoot="waveform",perSheet=1,workers=1):
+  '''
+  Render the waveforms at rows inds of
+  waves and z. With more than one worker
+  the rows are split in to batches of
+  whole sheets and rendered in parallel.
+  All share one frame fitted to every
+  row, so plots match a serial run
+  '''
+  inds=list(inds)
+  frame=waveFrame(waves,z,inds)
+  if(workers<=1):
+    return(renderBatch(np.asarray(waves[inds]),np.asarray(z[inds]),inds,outRoot,perSheet=perSheet,frame=frame))
+
+  # whole sheets per batch, so names match a serial run
+  batch=max(WORKER_BATCH//perSheet,1)*perSheet
+  names=[]
+  with ProcessPoolExecutor(max_workers=workers) as pool:
+    futures=[]
+    for s in range(0,len(inds),batch):
+      use=inds[s:s+batch]
+      futures.append(pool.submit(renderBatch,np.asarray(waves[use]),np.asarray(z[use]),use,outRoot,perSheet,frame))
+    for future in futures:
+      names.extend(future.result())
+  return(names)
+
+
+###########################################
+